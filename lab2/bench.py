@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Benchmarks for the CNF transformation on synthetic grammars """
+import os
+import random
+import time
+
+from main import Cfg, CfgRule, EMPTY_SYMBOL
+from main import transform_cfg_to_chomsky_normal_form, InternedCfg, transform_interned_cfg_to_chomsky_normal_form
+from cyk import CykParser
+
+EQUAL_AB_GRAMMAR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input2.txt')
+
+def make_grammar_string(rules_n, seed=0, max_rhs_len=6, reduced=True):
+    """ Random grammar with rules_n rules, in the reduced form unless reduced=False,
+    then about a tenth of the rules are unit or epsilon rules.
+    """
+    rng = random.Random(seed)
+    nonterminals_n = max(1, rules_n // 4)
+    nonterminals = ['N{}'.format(i) for i in range(nonterminals_n)]
+    terminals = ['t{}'.format(i) for i in range(max(2, rules_n // 20))]
+    rules = ['{} -> {}'.format(n, rng.choice(terminals)) for n in nonterminals]
+    rules.extend('{} -> {} {}'.format(nonterminals[(i - 1) // 2], n, rng.choice(terminals)) # all reachable
+                 for i, n in enumerate(nonterminals) if i)
+    while len(rules) < rules_n:
+        rhs_len = rng.randint(2, max_rhs_len)
+        rhs = [rng.choice(nonterminals) if rng.random() < 0.7 else rng.choice(terminals) for _ in range(rhs_len)]
+        if not reduced and rng.random() < 0.1:
+            rhs = [rng.choice(nonterminals + [EMPTY_SYMBOL])]
+        rules.append('{} -> {}'.format(rng.choice(nonterminals), ' '.join(rhs)))
+    return '\n'.join([str(len(nonterminals)), ' '.join(nonterminals), str(len(terminals)), ' '.join(terminals),
+                      str(len(rules))] + rules + [nonterminals[0]])
+
+class LegacyCfgRule(CfgRule):
+    """ Rule hashed and compared by its string form, as before the interning """
+    def __hash__(self):
+        return hash(self.to_string())
+    def __eq__(self, v):
+        return self.to_string() == v.to_string()
+
+def transform_cfg_to_chomsky_normal_form_legacy(cfg):
+    new_rules = set()
+    new_nonterminals = set()
+    for rule in cfg.rules:
+        rule = LegacyCfgRule(rule.lhs, list(rule.rhs))
+        new_nonterminals.add(rule.lhs)
+        if len(rule.rhs) == 1:
+            assert rule.rhs[0] in cfg.terminals or rule.rhs[0] == EMPTY_SYMBOL
+            new_rules.add(rule)
+            continue
+        def make_nonterminal(s):
+            if s in cfg.nonterminals:
+                return s
+            ret = s + "'"
+            new_nonterminals.add(ret)
+            new_rules.add(LegacyCfgRule(ret, [s]))
+            return ret
+        if len(rule.rhs) == 2:
+            new_rules.add(LegacyCfgRule(rule.lhs, list(map(make_nonterminal, rule.rhs))))
+            continue
+        cur_lhs, cur_rhs = rule.lhs, rule.rhs
+        while len(cur_rhs) >= 2:
+            rest_symbols = cur_rhs[1:]
+            new_nonterminal = '<{}>'.format(' '.join(rest_symbols)) if len(cur_rhs) > 2 else make_nonterminal(rest_symbols[0])
+            new_nonterminals.add(new_nonterminal)
+            new_rules.add(LegacyCfgRule(cur_lhs, [make_nonterminal(cur_rhs[0]), new_nonterminal]))
+            cur_lhs = new_nonterminal
+            cur_rhs.pop(0)
+    return Cfg(cfg.terminals, new_nonterminals, cfg.start_symbol, new_rules)
+
+def timed(f, *args):
+    start = time.perf_counter()
+    ret = f(*args)
+    return ret, time.perf_counter() - start
+
+def bench_cnf(sizes=(10 ** 4, 10 ** 5, 10 ** 6), legacy_max_size=10 ** 5):
+    print('seconds, synthetic grammars')
+    print('%10s %10s %10s %10s' % ('rules', 'parse', 'legacy', 'interned'))
+    for rules_n in sizes:
+        s = make_grammar_string(rules_n)
+        cfg, parse_time = timed(Cfg.from_string, s)
+        legacy_time = float('nan')
+        if rules_n <= legacy_max_size:
+            legacy_cfg, legacy_time = timed(transform_cfg_to_chomsky_normal_form_legacy, Cfg.from_string(s))
+        nf_cfg, cnf_time = timed(transform_cfg_to_chomsky_normal_form, cfg, True)
+        if rules_n <= legacy_max_size:
+            assert set(map(CfgRule.to_string, nf_cfg.rules)) == set(map(CfgRule.to_string, legacy_cfg.rules))
+        print('%10d %10.3f %10.3f %10.3f' % (rules_n, parse_time, legacy_time, cnf_time))
+
+def bench_reduce(sizes=(10 ** 4, 10 ** 5, 10 ** 6)):
+    print('seconds, synthetic grammars with unit and epsilon rules')
+    print('%10s %10s %10s' % ('rules', 'cnf', 'rules out'))
+    for rules_n in sizes:
+        cfg = InternedCfg.from_cfg(Cfg.from_string(make_grammar_string(rules_n, max_rhs_len=4, reduced=False)))
+        nf_cfg, cnf_time = timed(transform_interned_cfg_to_chomsky_normal_form, cfg)
+        print('%10d %10.3f %10d' % (rules_n, cnf_time, len(nf_cfg.rules)))
+
+def bench_binarization(sizes=(10 ** 4, 10 ** 5), max_rhs_len=16):
+    print('CNF output size, synthetic grammars with rhs up to {} symbols'.format(max_rhs_len))
+    print('%10s %10s %10s %14s %14s' % ('rules', 'rules out', 'nonterms', 'readable, KB', 'compact, KB'))
+    for rules_n in sizes:
+        cfg = Cfg.from_string(make_grammar_string(rules_n, max_rhs_len=max_rhs_len))
+        readable = transform_cfg_to_chomsky_normal_form(cfg, readable_names=True)
+        compact = transform_cfg_to_chomsky_normal_form(cfg)
+        print('%10d %10d %10d %14.0f %14.0f' % (rules_n, len(compact.rules), len(compact.nonterminals),
+                                                len(readable.to_string()) / 1024.0, len(compact.to_string()) / 1024.0))
+
+def bench_cyk(lengths=(10, 50, 100, 200, 500), seed=0):
+    """ Sentences with equal numbers of a and b, all of them are in the input2.txt language """
+    with open(EQUAL_AB_GRAMMAR) as f:
+        parser = CykParser(transform_cfg_to_chomsky_normal_form(Cfg.from_string(f.read())))
+    rng = random.Random(seed)
+    print('CYK sentences/sec, input2.txt grammar')
+    print('%8s %12s %12s' % ('length', 'recognize', 'forest'))
+    for length in lengths:
+        sentences = []
+        for _ in range(max(1, 1000 // length)):
+            sentence = list('ab' * (length // 2))
+            rng.shuffle(sentence)
+            sentences.append(sentence)
+        _, recognize_time = timed(lambda: [parser.recognize(s) for s in sentences])
+        _, forest_time = timed(lambda: [parser.parse_forest(s) for s in sentences])
+        print('%8d %12.2f %12.2f' % (length, len(sentences) / recognize_time, len(sentences) / forest_time))
+
+if __name__ == '__main__':
+    bench_cnf()
+    bench_binarization()
+    bench_cyk()
+    bench_reduce()
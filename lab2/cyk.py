@@ -0,0 +1,122 @@
+import numpy as np
+
+from main import EMPTY_SYMBOL
+
+class ParseForest(object):
+    """ Shared packed parse forest.
+    Nodes are (nonterminal, start, length), every node maps to the list of its packed
+    alternatives: (terminal,) for a terminal rule or (left node, right node) for a binary one.
+    """
+    def __init__(self, root, nodes):
+        self.root = root
+        self.nodes = nodes
+    def count_trees(self):
+        counts = {}
+        for node in sorted(self.nodes, key=lambda n: n[2]): # children are shorter than their parent
+            counts[node] = sum(1 if len(alt) == 1 else counts[alt[0]] * counts[alt[1]] for alt in self.nodes[node])
+        return counts.get(self.root, 0)
+    def tree(self, node=None):
+        """ The first parse tree as nested (nonterminal, children...) tuples """
+        node = self.root if node is None else node
+        alt = self.nodes[node][0]
+        if len(alt) == 1:
+            return (node[0], alt[0])
+        return (node[0], self.tree(alt[0]), self.tree(alt[1]))
+
+class CykParser(object):
+    """ CYK over a grammar in Chomsky normal form.
+    The chart holds one bit per nonterminal for every span: chart[length, start] is
+    a packed little-endian bitset, all spans of one length are combined at once by
+    bitwise operations over the split points.
+    """
+    def __init__(self, cfg):
+        self._cfg = cfg
+        self._nonterminals = sorted(cfg.nonterminals)
+        index = {n: i for i, n in enumerate(self._nonterminals)}
+        self._words_n = (len(self._nonterminals) + 7) // 8
+        terminal_nonterminals = {}
+        binary_rules = []
+        self._empty = False
+        for rule in cfg.rules:
+            if rule.rhs == [EMPTY_SYMBOL]:
+                assert rule.lhs == cfg.start_symbol
+                self._empty = True
+            elif len(rule.rhs) == 1:
+                terminal_nonterminals.setdefault(rule.rhs[0], []).append(index[rule.lhs])
+            else:
+                assert len(rule.rhs) == 2, rule
+                binary_rules.append((index[rule.lhs], index[rule.rhs[0]], index[rule.rhs[1]]))
+        self._terminal_bits = {t: self._pack(np.array(sorted(ns))) for t, ns in terminal_nonterminals.items()}
+        binary_rules.sort() # rules of one lhs are adjacent for the reduceat
+        rules = np.array(binary_rules, dtype=np.intp).reshape(-1, 3)
+        self._rules_lhs, self._rules_left, self._rules_right = (np.ascontiguousarray(v) for v in rules.T)
+        self._lhs_starts = np.flatnonzero(np.r_[True, rules[1:, 0] != rules[:-1, 0]]) if len(rules) else rules[:, 0]
+        self._rules_by_lhs = {}
+        for a, b, c in binary_rules:
+            self._rules_by_lhs.setdefault(a, []).append((b, c))
+        self._start = index.get(cfg.start_symbol)
+    def _pack(self, nonterminals):
+        bits = np.zeros(self._words_n * 8, dtype=bool)
+        bits[nonterminals] = True
+        return np.packbits(bits, bitorder='little')
+    @staticmethod
+    def _bits(words, nonterminals):
+        """ Bits of the nonterminals in the packed bitsets of the last axis """
+        return (words[..., nonterminals >> 3] >> (nonterminals & 7).astype(np.uint8)) & 1
+    def chart(self, tokens):
+        n = len(tokens)
+        chart = np.zeros((n + 1, n + 1, self._words_n), dtype=np.uint8)
+        empty = np.zeros(self._words_n, dtype=np.uint8)
+        for i, token in enumerate(tokens):
+            chart[1, i] = self._terminal_bits.get(token, empty)
+        if not len(self._rules_lhs):
+            return chart
+        for length in range(2, n + 1):
+            starts_n = n - length + 1
+            fired = np.zeros((starts_n, len(self._rules_lhs)), dtype=np.uint8)
+            for m in range(1, length):
+                fired |= self._bits(chart[m, :starts_n], self._rules_left) & \
+                    self._bits(chart[length - m, m:m + starts_n], self._rules_right)
+            lhs_fired = np.logical_or.reduceat(fired, self._lhs_starts, axis=1)
+            bits = np.zeros((starts_n, self._words_n * 8), dtype=bool)
+            bits[:, self._rules_lhs[self._lhs_starts]] = lhs_fired
+            chart[length, :starts_n] = np.packbits(bits, axis=1, bitorder='little')
+        return chart
+    def _has(self, chart, nonterminal, length, start):
+        return (chart[length, start, nonterminal >> 3] >> (nonterminal & 7)) & 1
+    def recognize(self, tokens):
+        if not tokens:
+            return self._empty
+        if self._start is None:
+            return False
+        return bool(self._has(self.chart(tokens), self._start, len(tokens), 0))
+    def parse_forest(self, tokens):
+        """ ParseForest of all parses or None if the tokens are not in the language """
+        if not tokens:
+            root = (self._cfg.start_symbol, 0, 0)
+            return ParseForest(root, {root: [(EMPTY_SYMBOL,)]}) if self._empty else None
+        chart = self.chart(tokens)
+        if self._start is None or not self._has(chart, self._start, len(tokens), 0):
+            return None
+        name = self._nonterminals.__getitem__
+        nodes = {}
+        root = (self._start, 0, len(tokens))
+        q = [root]
+        seen = set(q)
+        for a, start, length in q:
+            alts = []
+            if length == 1:
+                alts.append((tokens[start],))
+            for b, c in self._rules_by_lhs.get(a, ()):
+                ms = np.arange(1, length)
+                splits = ms[(self._bits(chart[ms, start], np.array([b])).ravel() &
+                             self._bits(chart[length - ms, start + ms], np.array([c])).ravel()).astype(bool)]
+                for m in splits.tolist():
+                    left, right = (b, start, m), (c, start + m, length - m)
+                    for child in (left, right):
+                        if child not in seen:
+                            seen.add(child)
+                            q.append(child)
+                    alts.append(((name(b), start, m), (name(c), start + m, length - m)))
+            nodes[name(a), start, length] = alts
+        return ParseForest((name(root[0]), 0, len(tokens)), nodes)
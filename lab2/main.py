@@ -1,6 +1,14 @@
+import glob
+import hashlib
+import itertools
+import json
+import os
 import six
 import sys
+import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 EMPTY_SYMBOL = '__empty__'
 
@@ -20,11 +28,11 @@ class CfgRule(object):
         assert self.lhs and self.rhs
         return '{} -> {}'.format(self.lhs, ' '.join(self.rhs))
     def __hash__(self):
-        return hash(self.to_string())
+        return hash((self.lhs, tuple(self.rhs)))
     def __repr__(self):
         return self.to_string()
     def __eq__(self, v):
-        return self.to_string() == v.to_string()
+        return self.lhs == v.lhs and self.rhs == v.rhs
 
 class Cfg(object): # context-free grammar
     def __init__(self, terminals, nonterminals, start_symbol, rules):
@@ -46,11 +54,12 @@ class Cfg(object): # context-free grammar
         assert n == len(terminals)
         n = int(lines.pop(0))
         assert n > 0
-        symbols = nonterminals + terminals + [EMPTY_SYMBOL]
+        symbols = set(nonterminals + terminals + [EMPTY_SYMBOL])
+        nonterminals_set = set(nonterminals)
         rules = []
         for line in lines[:n]:
             rule = CfgRule.from_string(line)
-            assert rule.lhs in nonterminals
+            assert rule.lhs in nonterminals_set
             assert all(s in symbols for s in rule.rhs)
             rules.append(rule)
         del lines[:n]
@@ -72,42 +81,226 @@ class Cfg(object): # context-free grammar
         ret.append(self.start_symbol)
         return '\n'.join(ret)
 
-def transform_cfg_to_chomsky_normal_form(cfg):
+class SymbolTable(object):
+    """ Maps symbol names to dense int ids and back """
+    def __init__(self, names=()):
+        self._ids = {}
+        self._names = []
+        for name in names:
+            self.intern(name)
+    def intern(self, name):
+        i = self._ids.get(name)
+        if i is None:
+            i = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return i
+    def get(self, name):
+        return self._ids.get(name)
+    def name(self, i):
+        return self._names[i]
+    def __contains__(self, name):
+        return name in self._ids
+    def __len__(self):
+        return len(self._names)
+
+class InternedCfg(object):
+    """ Cfg with symbols replaced by ids of the symbol table and rules stored
+    as (lhs, rhs tuple) pairs of ids. tails maps nonterminals generated for rhs
+    tails by the binarization to (head symbol, rest), where rest is another
+    tail nonterminal or the last symbol of the tail.
+    """
+    def __init__(self, symbols, terminals, nonterminals, start_symbol, rules, tails=None):
+        self.symbols = symbols
+        self.terminals = terminals
+        self.nonterminals = nonterminals
+        self.start_symbol = start_symbol
+        self.rules = rules
+        self.tails = tails or {}
+    @classmethod
+    def from_cfg(cls, cfg):
+        symbols = SymbolTable([EMPTY_SYMBOL])
+        terminals = set(map(symbols.intern, cfg.terminals))
+        nonterminals = set(map(symbols.intern, cfg.nonterminals))
+        rules = [(symbols.intern(r.lhs), tuple(map(symbols.intern, r.rhs))) for r in cfg.rules]
+        return cls(symbols, terminals, nonterminals, symbols.intern(cfg.start_symbol), rules)
+    def readable_name(self, s):
+        """ Tail nonterminals are named by the symbols of the tail """
+        if s not in self.tails:
+            return self.symbols.name(s)
+        tail = []
+        while s in self.tails:
+            head, s = self.tails[s]
+            tail.append(head)
+        tail.append(s)
+        return '<{}>'.format(' '.join(map(self.symbols.name, tail)))
+    def to_cfg(self, readable_names=False):
+        name = self.readable_name if readable_names else self.symbols.name
+        rules = [CfgRule(name(lhs), [name(s) for s in rhs]) for lhs, rhs in self.rules]
+        return Cfg([name(s) for s in self.terminals], [name(s) for s in self.nonterminals], name(self.start_symbol), rules)
+
+def _fresh_nonterminal(symbols, name):
+    while name in symbols:
+        name += '0'
+    return symbols.intern(name)
+
+def _nullable_or_generating_symbols(rules, known, occurrences_filter):
+    """ Worklist fixpoint: lhs of a rule becomes known when all its rhs symbols are known.
+    Every rule keeps a counter of unknown rhs occurrences, every symbol an index of
+    the rules it occurs in, so each occurrence is processed once.
+    """
+    known = set(known)
+    pending = [0] * len(rules)
+    occurrences = defaultdict(list)
+    queue = []
+    for i, (lhs, rhs) in enumerate(rules):
+        for s in rhs:
+            if s not in known and occurrences_filter(s):
+                pending[i] += 1
+                occurrences[s].append(i)
+            elif s not in known:
+                pending[i] = -1 # never becomes known
+                break
+        if not pending[i]:
+            queue.append(lhs)
+    while queue:
+        s = queue.pop()
+        if s in known:
+            continue
+        known.add(s)
+        for i in occurrences.pop(s, ()):
+            if pending[i] > 0:
+                pending[i] -= 1
+                if not pending[i]:
+                    queue.append(rules[i][0])
+    return known
+
+def remove_epsilon_rules(cfg):
+    """ Only the start symbol may derive the empty string afterwards, by a single
+    rule, and then it does not occur in any rhs.
+    A rule with k nullable symbols has 2^k variants, so the rules are binarized first.
+    """
+    empty = cfg.symbols.intern(EMPTY_SYMBOL)
+    nullable = _nullable_or_generating_symbols(cfg.rules, (empty,), lambda s: s in cfg.nonterminals)
+    nullable.discard(empty)
+    if not nullable:
+        return cfg
+    new_rules = set()
+    for lhs, rhs in cfg.rules:
+        if rhs == (empty,):
+            continue
+        options = [((s,), ()) if s in nullable else ((s,),) for s in rhs]
+        for parts in itertools.product(*options):
+            new_rhs = tuple(itertools.chain.from_iterable(parts))
+            if new_rhs:
+                new_rules.add((lhs, new_rhs))
+    start_symbol, nonterminals = cfg.start_symbol, cfg.nonterminals
+    if start_symbol in nullable:
+        if any(start_symbol in rhs for _, rhs in new_rules):
+            start_symbol = _fresh_nonterminal(cfg.symbols, cfg.symbols.name(cfg.start_symbol) + '0')
+            nonterminals = nonterminals | set((start_symbol,))
+            new_rules.add((start_symbol, (cfg.start_symbol,)))
+        new_rules.add((start_symbol, (empty,)))
+    return InternedCfg(cfg.symbols, cfg.terminals, nonterminals, start_symbol, list(new_rules), cfg.tails)
+
+def remove_unit_rules(cfg):
+    unit_successors = defaultdict(list)
+    rules_by_lhs = defaultdict(list)
+    for lhs, rhs in cfg.rules:
+        if len(rhs) == 1 and rhs[0] in cfg.nonterminals:
+            unit_successors[lhs].append(rhs[0])
+        else:
+            rules_by_lhs[lhs].append(rhs)
+    if not unit_successors:
+        return cfg
+    new_rules = set()
+    for lhs in cfg.nonterminals:
+        unit_reachable = set((lhs,))
+        q = [lhs]
+        for nonterminal in q:
+            new_rules.update((lhs, rhs) for rhs in rules_by_lhs.get(nonterminal, ()))
+            for s in unit_successors.get(nonterminal, ()):
+                if s not in unit_reachable:
+                    unit_reachable.add(s)
+                    q.append(s)
+    return InternedCfg(cfg.symbols, cfg.terminals, cfg.nonterminals, cfg.start_symbol, list(new_rules), cfg.tails)
+
+def remove_useless_symbols(cfg):
+    """ Remove non-generating and then unreachable nonterminals with their rules """
+    empty = cfg.symbols.intern(EMPTY_SYMBOL)
+    generating = _nullable_or_generating_symbols(cfg.rules, cfg.terminals | set((empty,)),
+                                                 lambda s: s in cfg.nonterminals)
+    if cfg.start_symbol not in generating:
+        raise ValueError('CFG generates the empty language')
+    rules_by_lhs = defaultdict(list)
+    for lhs, rhs in cfg.rules:
+        if all(s in generating for s in rhs):
+            rules_by_lhs[lhs].append(rhs)
+    reachable = set((cfg.start_symbol,))
+    q = [cfg.start_symbol]
+    for nonterminal in q:
+        for rhs in rules_by_lhs[nonterminal]:
+            for s in rhs:
+                if s in cfg.nonterminals and s not in reachable:
+                    reachable.add(s)
+                    q.append(s)
+    new_rules = [(lhs, rhs) for lhs in q for rhs in rules_by_lhs[lhs]]
+    return InternedCfg(cfg.symbols, cfg.terminals, cfg.nonterminals & reachable, cfg.start_symbol, new_rules, cfg.tails)
+
+def binarize_interned_cfg(cfg):
+    """ Long rules are binarized through a hash-consed table of rhs tails keyed by
+    (head symbol, rest), so equal tails of all rules share one generated nonterminal
+    with a short name. The terminals of the rules of two or more symbols are replaced
+    by nonterminals, the rules of a single symbol are kept.
+    """
+    symbols = cfg.symbols
     new_rules = set()
     new_nonterminals = set()
+    tails = {}
+    tail_nonterminals = {}
 
-    for rule in cfg.rules:
-        new_nonterminals.add(rule.lhs)
-        if len(rule.rhs) == 1:
-            assert rule.rhs[0] in cfg.terminals or rule.rhs[0] == EMPTY_SYMBOL
-            new_rules.add(rule)
-            continue
+    def make_nonterminal(s):
+        if s in cfg.nonterminals:
+            return s
+        ret_name = symbols.name(s) + "'"
+        assert symbols.get(ret_name) not in cfg.nonterminals
+        ret = symbols.intern(ret_name)
+        new_nonterminals.add(ret)
+        new_rules.add((ret, (s,)))
+        return ret
 
-        def make_nonterminal(s):
-            if s in cfg.nonterminals:
-                return s
-            ret = s + "'"
-            assert ret not in cfg.nonterminals
+    def make_tail_nonterminal(head, rest, rest_nonterminal):
+        ret = tail_nonterminals.get((head, rest))
+        if ret is None:
+            ret = _fresh_nonterminal(symbols, '<{}>'.format(len(tails)))
+            tail_nonterminals[head, rest] = ret
+            tails[ret] = (head, rest)
             new_nonterminals.add(ret)
-            new_rules.add(CfgRule(ret, [s]))
-            return ret
+            new_rules.add((ret, (make_nonterminal(head), rest_nonterminal)))
+        return ret
 
-        if len(rule.rhs) == 2:
-            new_rhs = list(map(make_nonterminal, rule.rhs))
-            new_rules.add(CfgRule(rule.lhs, new_rhs))
+    for lhs, rhs in cfg.rules:
+        new_nonterminals.add(lhs)
+        if len(rhs) == 1:
+            new_rules.add((lhs, rhs))
             continue
 
-        assert len(rule.rhs) > 2
-        cur_lhs, cur_rhs = rule.lhs, rule.rhs
-        while len(cur_rhs) >= 2:
-            rest_symbols = cur_rhs[1:]
-            new_nonterminal = '<{}>'.format(' '.join(rest_symbols)) if len(cur_rhs) > 2 else make_nonterminal(rest_symbols[0])
-            new_rule = CfgRule(cur_lhs, [make_nonterminal(cur_rhs[0]), new_nonterminal])
-            new_nonterminals.add(new_nonterminal)
-            new_rules.add(new_rule)
-            cur_lhs = new_nonterminal
-            cur_rhs.pop(0)
-    return Cfg(cfg.terminals, new_nonterminals, cfg.start_symbol, new_rules)
+        rest = rhs[-1]
+        rest_nonterminal = make_nonterminal(rest)
+        for i in range(len(rhs) - 2, 0, -1):
+            rest = rest_nonterminal = make_tail_nonterminal(rhs[i], rest, rest_nonterminal)
+        new_rules.add((lhs, (make_nonterminal(rhs[0]), rest_nonterminal)))
+    return InternedCfg(symbols, cfg.terminals, new_nonterminals, cfg.start_symbol, list(new_rules), tails)
+
+def transform_interned_cfg_to_chomsky_normal_form(cfg):
+    """ TERM and BIN, then DEL and UNIT: every binarized rule has at most 2 nullable
+    symbols, so the epsilon rules are removed in linear time. The useless symbols are
+    removed before the binarization and the ones left by the unit rules afterwards.
+    """
+    cfg = binarize_interned_cfg(remove_useless_symbols(cfg))
+    return remove_useless_symbols(remove_unit_rules(remove_epsilon_rules(cfg)))
+
+def transform_cfg_to_chomsky_normal_form(cfg, readable_names=False):
+    return transform_interned_cfg_to_chomsky_normal_form(InternedCfg.from_cfg(cfg)).to_cfg(readable_names)
 
 def validate_cfg_reduced_form(cfg):
     assert cfg.rules
@@ -124,11 +317,107 @@ def validate_cfg_reduced_form(cfg):
                 return False
     return True
 
+BATCH_CACHE_FILE = 'cache.json'
+BATCH_TIMINGS_FILE = 'timings.txt'
+
+def convert_grammar(input_str, readable_names=False):
+    """ Batch worker: (CNF text or None, error or None, input was reduced, seconds) """
+    start = time.perf_counter()
+    try:
+        cfg = Cfg.from_string(input_str)
+        reduced = validate_cfg_reduced_form(cfg)
+        nf_cfg = transform_cfg_to_chomsky_normal_form(cfg, readable_names)
+        return nf_cfg.to_string() + '\n', None, reduced, time.perf_counter() - start
+    except Exception as e:
+        return None, repr(e), None, time.perf_counter() - start
+
+def find_grammar_files(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(p for p in sorted(glob.glob(os.path.join(pattern, '*'))) if os.path.isfile(p))
+        else:
+            paths.extend(p for p in sorted(glob.glob(pattern)) if os.path.isfile(p))
+    return paths
+
+def convert_grammar_files(paths, output_dir, jobs=None, readable_names=False):
+    """ Convert the files in a process pool into output_dir/<file name>.
+    Inputs whose content hash matches the cache of the previous run are skipped,
+    their seconds are the ones of the run that converted them.
+    Returns {file name: (status, seconds)}.
+    """
+    names = [os.path.basename(p) for p in paths]
+    if len(set(names)) != len(names):
+        raise ValueError('grammar file names should be unique')
+    reserved = set(names) & set((BATCH_CACHE_FILE, BATCH_TIMINGS_FILE))
+    if reserved:
+        raise ValueError('grammar file names are reserved for the batch metadata: {}'.format(', '.join(sorted(reserved))))
+    os.makedirs(output_dir, exist_ok=True)
+    cache_path = os.path.join(output_dir, BATCH_CACHE_FILE)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    inputs, results = {}, {}
+    for name, path in zip(names, paths):
+        with open(path) as f:
+            input_str = f.read()
+        digest = hashlib.sha256('{:d}\n{}'.format(readable_names, input_str).encode('utf-8')).hexdigest()
+        entry = cache.get(name)
+        if isinstance(entry, dict) and entry.get('digest') == digest and os.path.exists(os.path.join(output_dir, name)):
+            results[name] = ('cached', entry['seconds'])
+        else:
+            inputs[name] = (input_str, digest)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {name: executor.submit(convert_grammar, input_str, readable_names)
+                   for name, (input_str, _) in inputs.items()}
+        for name, future in futures.items():
+            text, error, reduced, seconds = future.result()
+            output_path = os.path.join(output_dir, name)
+            if error is not None: # no output of a previous run is left for it
+                cache.pop(name, None)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                results[name] = ('error: {}'.format(error), seconds)
+                continue
+            with open(output_path, 'w') as f:
+                f.write(text)
+            cache[name] = {'digest': inputs[name][1], 'seconds': seconds}
+            results[name] = ('ok' if reduced else 'ok (input not reduced)', seconds)
+
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    with open(os.path.join(output_dir, BATCH_TIMINGS_FILE), 'w') as f:
+        for name in names:
+            status, seconds = results[name]
+            f.write('{}\t{:.6f}\t{}\n'.format(name, seconds, status))
+    return results
+
 if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(description='Transform CFG to the Chomsky normal form')
+    argparser.add_argument('input_file', nargs='?', help='grammar file, stdin by default')
+    argparser.add_argument('--batch', nargs='+', metavar='DIR_OR_GLOB', help='convert many grammar files in parallel')
+    argparser.add_argument('--output-dir', help='output directory of the batch mode')
+    argparser.add_argument('--jobs', type=int, help='processes of the batch mode')
+    argparser.add_argument('--readable-names', action='store_true', help='name binarization nonterminals by their rhs')
+    args = argparser.parse_args()
+
+    if args.batch:
+        if not args.output_dir:
+            sys.exit('--output-dir is required in the batch mode')
+        try:
+            results = convert_grammar_files(find_grammar_files(args.batch), args.output_dir, args.jobs, args.readable_names)
+        except ValueError as e:
+            sys.exit(e)
+        for name, (status, seconds) in sorted(results.items()):
+            print('{}: {} ({:.3f}s)'.format(name, status, seconds))
+        sys.exit(1 if any(status.startswith('error') for status, _ in results.values()) else 0)
+
     try:
-        input_file = sys.argv[1] if len(sys.argv) == 2 else sys.stdin
-        if len(sys.argv) == 2:
-            with open(filename) as f:
+        if args.input_file:
+            with open(args.input_file) as f:
                 input_str = f.read()
         else:
             input_str = sys.stdin.read()
@@ -141,8 +430,8 @@ if __name__ == '__main__':
         traceback.print_exc()
         sys.exit('invalid input data format!')
 
-    if not validate_cfg_reduced_form(cfg):
-        sys.exit('input CFG should be in reduced form!')
-
-    nf_cfg = transform_cfg_to_chomsky_normal_form(cfg)
+    try:
+        nf_cfg = transform_cfg_to_chomsky_normal_form(cfg, args.readable_names)
+    except ValueError as e:
+        sys.exit(e)
     print(nf_cfg.to_string())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+""" Benchmarks for the backtracking parser on generated expressions """
+import contextlib
+import os
+import random
+import time
+
+from main import BacktrackedBottomUpParser, BatchStats, Bunch, expression_grammar, parse_lines, parse_rules
+
+OPERANDS = ('id', 'id1', 'id2', 'k', 'k1', 'k2')
+
+def make_expression(operands_n, rng, parens=True):
+    """ Random expression of the expression grammar with operands_n operands """
+    def ar_expr(n):
+        if n == 1:
+            return [rng.choice(OPERANDS)]
+        left = rng.randint(1, n - 1)
+        tokens = ar_expr(left) + [rng.choice('+-*/')] + ar_expr(n - left)
+        if parens and rng.random() < 0.2:
+            tokens = ['('] + tokens + [')']
+        return tokens
+    if operands_n >= 2 and rng.random() < 0.3:
+        left = rng.randint(1, operands_n - 1)
+        return ar_expr(left) + [rng.choice(('<', '<=', '=', '<>', '>', '>='))] + ar_expr(operands_n - left)
+    return ar_expr(operands_n)
+
+def run(parser, expressions, max_iter):
+    iterations = 0
+    results = []
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        for tokens in expressions:
+            results.append(parser.parse(tuple(tokens), max_iter=max_iter))
+            iterations += parser.last_iterations
+    return results, iterations, time.perf_counter() - start
+
+def bench_expressions(operands=(2, 3, 4, 5, 6), expressions_n=20, max_iter=10 ** 6, seed=0):
+    rng = random.Random(seed)
+    print('iterations and seconds for {} expressions, limit {} iterations'.format(expressions_n, max_iter))
+    print('%8s %12s %10s %10s' % ('operands', 'iterations', 's', 'limits'))
+    for operands_n in operands:
+        expressions = [make_expression(operands_n, rng) for _ in range(expressions_n)]
+        results, iterations, elapsed = run(BacktrackedBottomUpParser(expression_grammar), expressions, max_iter)
+        print('%8d %12d %10.3f %10d' % (operands_n, iterations, elapsed, results.count('iterations limit')))
+
+def bench_rule_index(padding=(0, 100, 1000), operands_n=4, expressions_n=20, max_iter=10 ** 6, seed=0):
+    """ The expression grammar padded with rules that never match """
+    rng = random.Random(seed)
+    expressions = [make_expression(operands_n, rng) for _ in range(expressions_n)]
+    print('{} expressions of {} operands, limit {} iterations'.format(expressions_n, operands_n, max_iter))
+    print('%8s %12s %12s %10s %10s' % ('rules', 'scan iter', 'index iter', 'scan, s', 'index, s'))
+    for padding_n in padding:
+        rules = expression_grammar.rules + parse_rules(*('<x{0}> -> x{0} <x{0}>'.format(i) for i in range(padding_n)))
+        gram = Bunch(start_symbol=expression_grammar.start_symbol, rules=rules)
+        scan, scan_iterations, scan_time = run(BacktrackedBottomUpParser(gram, index_rules=False), expressions, max_iter)
+        index, index_iterations, index_time = run(BacktrackedBottomUpParser(gram), expressions, max_iter)
+        assert scan == index
+        print('%8d %12d %12d %10.3f %10.3f' % (len(rules), scan_iterations, index_iterations, scan_time, index_time))
+
+def bench_steps(operands_n=5, expressions_n=20, max_iter=10 ** 6, seed=0):
+    """ Nanoseconds per fsm step for the parser options and the tracing hook """
+    rng = random.Random(seed)
+    expressions = [make_expression(operands_n, rng) for _ in range(expressions_n)]
+    def noop_trace(i, fsm_state, pos, l1, l2):
+        pass
+    configs = (
+        ('index', dict(), dict()),
+        ('scan', dict(index_rules=False), dict()),
+        ('trace 1e5', dict(), dict(trace=noop_trace, trace_every=10 ** 5)),
+        ('trace 1', dict(), dict(trace=noop_trace)),
+    )
+    print('{} expressions of {} operands, limit {} iterations'.format(expressions_n, operands_n, max_iter))
+    print('%14s %12s %10s %10s' % ('config', 'iterations', 's', 'ns/step'))
+    for name, parser_kwds, parse_kwds in configs:
+        parser = BacktrackedBottomUpParser(expression_grammar, **parser_kwds)
+        iterations = 0
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+            for tokens in expressions:
+                parser.parse(tuple(tokens), max_iter=max_iter, **parse_kwds)
+                iterations += parser.last_iterations
+        elapsed = time.perf_counter() - start
+        print('%14s %12d %10.3f %10.1f' % (name, iterations, elapsed, elapsed * 1e9 / iterations))
+
+def bench_batch(jobs=(1, 2, 4), operands=(2, 3, 4, 5), lines_n=100, max_iter=10 ** 5, seed=0):
+    """ Lines/sec of parse_lines, every line limited to max_iter iterations.
+    A line is sent to a worker alone, chunksize=1, so one expensive line does not hold up others.
+    More jobs help only on more cores and while no single line dominates the batch.
+    """
+    rng = random.Random(seed)
+    lines = [' '.join(make_expression(rng.choice(operands), rng)) for _ in range(lines_n)]
+    parser = BacktrackedBottomUpParser(expression_grammar)
+    expected = None
+    print('{} lines of {} operands, limit {} iterations per line'.format(lines_n, operands, max_iter))
+    for jobs_n in jobs:
+        stats = BatchStats()
+        results = []
+        for line, r, iterations, seconds in parse_lines(parser, lines, jobs_n, max_iter):
+            stats.add(r, iterations)
+            results.append(r)
+        assert expected is None or results == expected
+        expected = results
+        print('jobs {}: {}'.format(jobs_n, stats.summary()))
+
+if __name__ == '__main__':
+    bench_expressions()
+    bench_rule_index()
+    bench_steps()
+    bench_batch()
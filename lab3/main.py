@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from bisect import bisect_left
 
 DEBUG = os.environ.get('DEBUG') == '1'
+MAX_ITER = int(1e9)
+FSM_REDUCE, FSM_SHIFT, FSM_VERIFY, FSM_BACKTRACK_CHANGE_STATE, FSM_BACKTRACK, FSM_FINISH, FSM_ERROR = range(7)
+FSM_STATE_NAMES = ('reduce', 'shift', 'verify', 'backtrack_change_state', 'backtrack', 'finish', 'error')
+SHIFT_MARK = -1
+PROGRESS_ITERATIONS = 10 ** 5
+TIME_CHECK_ITERATIONS = 10 ** 4
+LIMIT_RESULTS = ('iterations limit', 'time limit')
 
 class Bunch:
     def __init__(self, **kwds):
@@ -24,97 +35,168 @@ def list_tail_eq(a, b):
 def warn(str_):
     sys.stderr.write(str_ + '\n')
 
+class StackTable(object):
+    """ Hash-consed persistent stacks: a stack is an int id of its top node,
+    equal stacks have equal ids, so a stack is hashed and compared in O(1).
+    """
+    EMPTY = 0
+    def __init__(self):
+        self._nodes = {}
+        self._parents = [None]
+        self._symbols = [None]
+    def push(self, stack, symbol):
+        node = self._nodes.get((stack, symbol))
+        if node is None:
+            node = self._nodes[stack, symbol] = len(self._parents)
+            self._parents.append(stack)
+            self._symbols.append(symbol)
+        return node
+    def pop(self, stack):
+        return self._parents[stack]
+    def top(self, stack):
+        return self._symbols[stack]
+
+def build_reversed_rhs_trie(rules):
+    """ Trie of the reversed rules rhs, each node keeps the sorted indices of
+    the rules whose rhs ends there. Root children index the rules by the last rhs symbol.
+    """
+    root = Bunch(children={}, rules=[])
+    for i, rule in enumerate(rules):
+        node = root
+        for symbol in reversed(rule.rhs):
+            node = node.children.setdefault(symbol, Bunch(children={}, rules=[]))
+        node.rules.append(i)
+    return root
+
 class BacktrackedBottomUpParser(object):
-    def __init__(self, gram):
+    """ With index_rules=True the rules to reduce are looked up in the reversed rhs trie,
+    the matching rules are cached per stack node of the configuration.
+    """
+    def __init__(self, gram, index_rules=True):
         self._gram = gram
-    def _reduce_with_min_rule_index(self, cfg, min_rule_i):
-        if not cfg.l1:
-            return 'shift'
-        last_l1_symbol = cfg.l1[-1]
+        self._index_rules = index_rules
+        self._rhs_trie = build_reversed_rhs_trie(gram.rules)
+        self.last_iterations = 0
+    def _matching_rules(self, stacks, matching, stack):
+        """ Sorted indices of the rules whose rhs is a tail of the stack, cached per stack node in matching """
+        rules = matching.get(stack)
+        if rules is None:
+            rules = []
+            node, s = self._rhs_trie, stack
+            while s != StackTable.EMPTY:
+                node = node.children.get(stacks.top(s))
+                if node is None:
+                    break
+                rules.extend(node.rules)
+                s = stacks.pop(s)
+            rules = matching[stack] = sorted(rules)
+        return rules
+    def _find_rule_to_reduce(self, stacks, matching, l1, l1_ids, min_rule_i):
+        if not l1:
+            return None
+        if self._index_rules:
+            rules = self._matching_rules(stacks, matching, l1_ids[-1])
+            k = bisect_left(rules, min_rule_i)
+            return rules[k] if k < len(rules) else None
+        last_l1_symbol = l1[-1]
         for i in range(min_rule_i, len(self._gram.rules)):
             rule = self._gram.rules[i]
-            if last_l1_symbol == rule.rhs[-1] and list_tail_eq(cfg.l1, rule.rhs): # comparison optimization
-                cfg.l1[-len(rule.rhs):] = [rule.lhs]
-                assert not list_tail_eq(cfg.l1, rule.rhs)
-                cfg.l2.append(i)
-                if DEBUG:
-                    print('reduced by rule {!r}'.format(rule))
-                return 'reduce'
-        if DEBUG:
-            print('cant reduce')
-        return 'shift'
-    def _reduce(self, cfg):
-        assert cfg.state == 'q'
-        return self._reduce_with_min_rule_index(cfg, 0)
-    def _shift(self, cfg, input_tokens):
-        if cfg.pos == len(input_tokens):
-            return 'verify'
-        cfg.l1.append(input_tokens[cfg.pos])
-        cfg.l2.append('s')
-        cfg.pos += 1
-        return 'reduce'
-    def _verify(self, cfg, input_tokens):
-        if cfg.pos == len(input_tokens) and cfg.l1 == [self._gram.start_symbol]:
-            cfg.state = 't'
-            return 'finish'
-        return 'backtrack_change_state'
-    def _backtrack_change_state(self, cfg, input_tokens):
-        assert cfg.pos == len(input_tokens) and cfg.state == 'q'
-        cfg.state = 'b'
-        return 'backtrack'
-    def _backtrack(self, cfg, input_tokens):
-        if cfg.pos == 0:
-            warn('backtracked to first symbol, error')
-            return 'error'
-        assert cfg.state == 'b'
-        if isinstance(cfg.l2[-1], int): # 5 a, b, c
-            j = cfg.l2.pop()
-            rule = self._gram.rules[j]
-            assert cfg.l1[-1] == rule.lhs
-            cfg.l1.pop()
-            cfg.l1.extend(rule.rhs)
-            assert list_tail_eq(cfg.l1, rule.rhs)
-            r = self._reduce_with_min_rule_index(cfg, j + 1) # try choose another rule
-            if r == 'reduce': # 5a, found another rule
-                cfg.state = 'q'
-                return r
-            assert r == 'shift' # rule wasn't found
-            if cfg.pos == len(input_tokens): # 5b, nothing to shift: end of input
-                return 'backtrack'
-            cfg.state = 'q'
-            return r # 5c, shift
-        # 5d
-        assert cfg.l2[-1] == 's' and cfg.l1[-1] == input_tokens[cfg.pos - 1]
-        cfg.l1.pop()
-        cfg.l2.pop()
-        cfg.pos -= 1
-        return 'backtrack'
-
-    def parse(self, input_tokens):
-        cfg = Bunch(state='q', pos=0, l1=[], l2=[])
-        fsm = {
-            'reduce': lambda: self._reduce(cfg),
-            'shift': lambda: self._shift(cfg, input_tokens),
-            'verify': lambda: self._verify(cfg, input_tokens),
-            'backtrack_change_state': lambda: self._backtrack_change_state(cfg, input_tokens),
-            'backtrack': lambda: self._backtrack(cfg, input_tokens)
-        }
-        fsm_state = 'reduce'
-        i, MAX_ITER = 0, 1e9
-        if DEBUG:
-            warn('#{}: fsm_state={}, cfg={!r}'.format(i, fsm_state, cfg))
-        while fsm_state not in ('finish', 'error') and i < MAX_ITER:
-            fsm_state = fsm[fsm_state]()
-            i += 1
-            if DEBUG:
-                warn('#{}: fsm_state={}, cfg={!r}'.format(i, fsm_state, cfg))
-            if i % 1e5 == 0:
-                warn('iter #{}'.format(i))
-        if i == MAX_ITER:
+            if last_l1_symbol == rule.rhs[-1] and list_tail_eq(l1, rule.rhs): # comparison optimization
+                return i
+        return None
+
+    def parse(self, input_tokens, max_iter=MAX_ITER, trace=None, trace_every=1, max_seconds=None):
+        """ Rule sequence ('s' for shifts) or an error string.
+        trace(i, fsm_state, pos, l1, l2) is called after every trace_every steps and
+        after the last one, the steps loop itself does not check for it.
+        max_seconds is checked between the chunks of steps, every TIME_CHECK_ITERATIONS without trace.
+        The stacks and the matching rules cache live for one call, the parser keeps none of them.
+        """
+        rules, start_symbol = self._gram.rules, self._gram.start_symbol
+        find_rule_to_reduce = self._find_rule_to_reduce
+        stacks, matching = StackTable(), {}
+        push = stacks.push
+        n = len(input_tokens)
+        pos, l1, l1_ids, l2 = 0, [], [StackTable.EMPTY], array('i') # l2: rule index or SHIFT_MARK
+        fsm_state = FSM_REDUCE
+        i = 0
+        every = trace_every if trace is not None else TIME_CHECK_ITERATIONS
+        chunked = trace is not None or max_seconds is not None
+        limit = min(every, max_iter) if chunked else max_iter
+        deadline = None if max_seconds is None else time.perf_counter() + max_seconds
+        timeout = False
+        if trace is not None:
+            trace(i, fsm_state, pos, l1, l2)
+        while True:
+            while fsm_state < FSM_FINISH and i < limit:
+                if fsm_state == FSM_REDUCE:
+                    rule_i = find_rule_to_reduce(stacks, matching, l1, l1_ids, 0)
+                    fsm_state = FSM_SHIFT
+                elif fsm_state == FSM_SHIFT:
+                    rule_i = None
+                    if pos == n:
+                        fsm_state = FSM_VERIFY
+                    else:
+                        l1.append(input_tokens[pos])
+                        l1_ids.append(push(l1_ids[-1], input_tokens[pos]))
+                        l2.append(SHIFT_MARK)
+                        pos += 1
+                        fsm_state = FSM_REDUCE
+                elif fsm_state == FSM_VERIFY:
+                    rule_i = None
+                    if pos == n and len(l1) == 1 and l1[0] == start_symbol:
+                        fsm_state = FSM_FINISH
+                    else:
+                        fsm_state = FSM_BACKTRACK_CHANGE_STATE
+                elif fsm_state == FSM_BACKTRACK_CHANGE_STATE:
+                    rule_i = None
+                    fsm_state = FSM_BACKTRACK
+                else:
+                    rule_i = None
+                    if pos == 0:
+                        warn('backtracked to first symbol, error')
+                        fsm_state = FSM_ERROR
+                    elif l2[-1] != SHIFT_MARK: # 5 a, b, c
+                        j = l2.pop()
+                        rule = rules[j]
+                        l1.pop()
+                        l1.extend(rule.rhs)
+                        l1_ids.pop()
+                        for symbol in rule.rhs:
+                            l1_ids.append(push(l1_ids[-1], symbol))
+                        rule_i = find_rule_to_reduce(stacks, matching, l1, l1_ids, j + 1) # try choose another rule
+                        if rule_i is None and pos < n: # 5c, shift, 5b backtracks at the end of input
+                            fsm_state = FSM_SHIFT
+                    else: # 5d
+                        l1.pop()
+                        l1_ids.pop()
+                        l2.pop()
+                        pos -= 1
+                if rule_i is not None: # reduce, 5a when backtracking
+                    rule = rules[rule_i]
+                    del l1[-len(rule.rhs):]
+                    l1.append(rule.lhs)
+                    del l1_ids[-len(rule.rhs):]
+                    l1_ids.append(push(l1_ids[-1], rule.lhs))
+                    l2.append(rule_i)
+                    fsm_state = FSM_REDUCE
+                i += 1
+            if trace is not None:
+                trace(i, fsm_state, pos, l1, l2)
+            if fsm_state >= FSM_FINISH or i >= max_iter:
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                timeout = True
+                break
+            limit = min(i + every, max_iter)
+        self.last_iterations = i
+        if i == max_iter:
             return 'iterations limit'
-        if fsm_state != 'finish':
+        if timeout:
+            return 'time limit'
+        if fsm_state != FSM_FINISH:
             return 'error occured'
-        return cfg.l2
+        return ['s' if r == SHIFT_MARK else r for r in l2]
 
 def parse_rules(*rules_strs):
     rules = []
@@ -123,28 +205,120 @@ def parse_rules(*rules_strs):
         rules.extend([Bunch(lhs=lhs, rhs=rhs.split(' ')) for rhs in multi_rhs.split(' | ')])
     return tuple(rules)
 
+expression_grammar = Bunch(
+    start_symbol='<выражение>',
+    rules=parse_rules(
+        '<выражение> -> <арифметическое_выражение> <операция_отношения> <арифметическое_выражение> | <арифметическое_выражение>',
+        '<арифметическое_выражение> -> <арифметическое_выражение> <операция_типа_сложения> <терм> | <терм>',
+        '<терм> -> <терм> <операция_типа_умножения> <фактор> | <фактор>',
+        '<фактор> -> <идентификатор> | <константа> | ( <арифметическое_выражение> )',
+        '<операция_отношения> -> < | <= | = | <> | > | >=',
+        '<операция_типа_сложения> -> + | -',
+        '<операция_типа_умножения> -> * | /',
+        '<идентификатор> -> id | id1 | id2',
+        '<константа> -> k | k1 | k2',
+    )
+)
+
+_batch_parser = None
+
+def _init_batch_worker(parser):
+    """ The parser and its rhs trie are sent to every worker once, not per line """
+    global _batch_parser
+    _batch_parser = parser
+
+def _parse_batch_line(args):
+    line, max_iter, max_seconds = args
+    start = time.perf_counter()
+    r = _batch_parser.parse(tuple(line.split(' ')), max_iter=max_iter, max_seconds=max_seconds)
+    return r, _batch_parser.last_iterations, time.perf_counter() - start
+
+def parse_lines(parser, lines, jobs=None, max_iter=MAX_ITER, max_seconds=None, chunksize=1):
+    """ Parse the lines in a process pool, yields (line, result, iterations, seconds) in the input order.
+    Every line has its own max_iter and max_seconds budget. jobs=1 parses in this process.
+    A line is parsed by one worker, the pool spreads the lines and does not split a line,
+    so a batch whose time goes to a single line parses no faster with more jobs.
+    """
+    lines = list(lines)
+    tasks = ((line, max_iter, max_seconds) for line in lines)
+    if jobs == 1:
+        _init_batch_worker(parser)
+        results = map(_parse_batch_line, tasks)
+        for line, (r, iterations, seconds) in zip(lines, results):
+            yield line, r, iterations, seconds
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(parser,)) as executor:
+        results = executor.map(_parse_batch_line, tasks, chunksize=chunksize)
+        for line, (r, iterations, seconds) in zip(lines, results):
+            yield line, r, iterations, seconds
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    """
+    if not sorted_values:
+        return 0
+    k = -(-len(sorted_values) * p // 100) # ceil
+    return sorted_values[max(k, 1) - 1]
+
+class BatchStats(object):
+    def __init__(self):
+        self.lines = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.iterations = []
+        self._start = time.perf_counter()
+        self.seconds = 0.0
+    def add(self, r, iterations):
+        self.lines += 1
+        self.iterations.append(iterations)
+        if r in LIMIT_RESULTS:
+            self.timeouts += 1
+        elif isinstance(r, str):
+            self.errors += 1
+        self.seconds = time.perf_counter() - self._start
+    def summary(self):
+        iterations = sorted(self.iterations)
+        return 'lines: {}, {:.1f} lines/sec, iterations p50: {}, p99: {}, timeouts: {}, errors: {}'.format(
+            self.lines, self.lines / self.seconds if self.seconds else 0.0,
+            percentile(iterations, 50), percentile(iterations, 99), self.timeouts, self.errors)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
 
-    gram = {
-        'start_symbol': '<выражение>',
-        'rules': parse_rules(
-            '<выражение> -> <арифметическое_выражение> <операция_отношения> <арифметическое_выражение> | <арифметическое_выражение>',
-            '<арифметическое_выражение> -> <арифметическое_выражение> <операция_типа_сложения> <терм> | <терм>',
-            '<терм> -> <терм> <операция_типа_умножения> <фактор> | <фактор>',
-            '<фактор> -> <идентификатор> | <константа> | ( <арифметическое_выражение> )',
-            '<операция_отношения> -> < | <= | = | <> | > | >=',
-            '<операция_типа_сложения> -> + | -',
-            '<операция_типа_умножения> -> * | /',
-            '<идентификатор> -> id | id1 | id2',
-            '<константа> -> k | k1 | k2',
-        )
-    }
-    for i, rule in enumerate(gram['rules']):
+    import argparse
+    argparser = argparse.ArgumentParser(description='Backtracking bottom-up parser of the expression grammar, sentences are stdin lines')
+    argparser.add_argument('--jobs', type=int, help='parse the lines in a process pool of this size, one line per worker')
+    argparser.add_argument('--max-iter', type=int, default=MAX_ITER, help='iterations limit per line')
+    argparser.add_argument('--max-seconds', type=float, help='time limit per line')
+    args = argparser.parse_args()
+
+    gram = expression_grammar
+    for i, rule in enumerate(gram.rules):
         print('rule #{}: {} -> {}'.format(i, rule.lhs, ' '.join(rule.rhs)))
     print('')
-    parser = BacktrackedBottomUpParser(Bunch(**gram))
+    parser = BacktrackedBottomUpParser(gram)
+    if args.jobs:
+        stats = BatchStats()
+        for line, r, iterations, seconds in parse_lines(parser, sys.stdin.read().splitlines(), args.jobs,
+                                                        args.max_iter, args.max_seconds):
+            stats.add(r, iterations)
+            print('{}: {}'.format(line, r))
+            sys.stdout.flush()
+        warn(stats.summary())
+        sys.exit(0)
+    def debug_trace(i, fsm_state, pos, l1, l2):
+        warn('#{}: fsm_state={}, pos={}, l1={}, l2={}'.format(i, FSM_STATE_NAMES[fsm_state], pos, l1, list(l2)))
+    def progress_trace(i, fsm_state, pos, l1, l2):
+        if i and i % PROGRESS_ITERATIONS == 0:
+            warn('iter #{}'.format(i))
     for line in sys.stdin.read().splitlines():
-        r = parser.parse(tuple(line.split(' ')))
+        if DEBUG:
+            r = parser.parse(tuple(line.split(' ')), args.max_iter, debug_trace, max_seconds=args.max_seconds)
+        else:
+            r = parser.parse(tuple(line.split(' ')), args.max_iter, progress_trace, PROGRESS_ITERATIONS, args.max_seconds)
         print('{}: {}'.format(line, r))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+""" Benchmarks for the program parser on generated programs """
+import random
+import sys
+import threading
+import time
+
+from main import Bunch, ParserError, Program, ProgramRecursiveDescentParser, TokenStream
+from incremental import IncrementalProgram
+
+def make_program_tokens(operators_n, seed=0, max_operands=4, block_size=1000):
+    """ Tokens of a program of operators_n assignments, every block_size of them open a nested block """
+    rng = random.Random(seed)
+    tokens = ['{']
+    for i in range(operators_n):
+        if i:
+            tokens.append(';')
+            if i % block_size == 0:
+                tokens.append('{')
+        tokens.extend(('id_{}'.format(i), '='))
+        for j in range(rng.randint(1, max_operands)):
+            if j:
+                tokens.append(rng.choice(('+', '-', '*', '/')))
+            if i and tokens[-1] != '/' and rng.random() < 0.5: # no division by zero
+                tokens.append('id_{}'.format(rng.randrange(i)))
+            else:
+                tokens.append(str(rng.randint(1, 9)))
+    tokens.extend('}' * (1 + (operators_n - 1) // block_size))
+    return tokens
+
+class PopFrontTokenStream(TokenStream):
+    """ The original token consumption by list.pop(0) """
+    __slots__ = ()
+    def advance(self):
+        self.pos = 0
+        return self.tokens.pop(0)
+
+class RecursiveProgramParser(ProgramRecursiveDescentParser):
+    """ The original right-recursive tail productions, a list ends by a caught ParserError """
+    def _match(self, matcher):
+        return self._try_match(matcher) or self._err('cant match by matcher {}', matcher)
+    def _parse_factor(self):
+        if self._is_on_top('('):
+            yield self._match_term('(')
+            yield from self._parse_ar_expr()
+            yield self._match_term(')')
+        else:
+            yield self._try_parse_id() or self._try_parse_constant() or self._err('invalid factor')
+    def _parse_term_rest(self):
+        yield self._match(lambda t: t in ('*', '/'))
+        yield from self._parse_factor()
+        try:
+            yield from self._parse_term_rest()
+        except ParserError:
+            pass
+    def _parse_term(self):
+        yield from self._parse_factor()
+        try:
+            yield from self._parse_term_rest()
+        except ParserError:
+            pass
+    def _parse_ar_expr_rest(self):
+        yield self._match(lambda t: t in ('+', '-'))
+        yield from self._parse_term()
+        try:
+            yield from self._parse_ar_expr_rest()
+        except ParserError:
+            pass
+    def _parse_ar_expr(self):
+        yield from self._parse_term()
+        try:
+            yield from self._parse_ar_expr_rest()
+        except ParserError:
+            pass
+    def _parse_expr(self):
+        yield from self._parse_ar_expr()
+        rel_res = self._try_parse_rel_op()
+        if rel_res:
+            yield rel_res
+            yield from self._parse_ar_expr()
+    def _parse_op(self):
+        if self._is_on_top('{'):
+            return self._parse_block()
+        lhs = self._parse_id()
+        self._match_term('=')
+        rhs = tuple(self._parse_expr())
+        self._operators.append(Bunch(lhs=lhs, rhs=rhs))
+    def _parse_op_tail(self):
+        try:
+            self._match_term(';')
+            self._parse_op()
+            self._parse_op_tail()
+        except ParserError:
+            pass
+    def _parse_op_list(self):
+        self._parse_op()
+        self._parse_op_tail()
+
+def run_deep(f, stack_size=1 << 30, recursion_limit=10 ** 8):
+    """ f() in a thread with a large stack, the parser recursion depth grows with the program """
+    result = []
+    old_limit, old_stack_size = sys.getrecursionlimit(), threading.stack_size()
+    sys.setrecursionlimit(recursion_limit)
+    threading.stack_size(stack_size)
+    try:
+        thread = threading.Thread(target=lambda: result.append(f()))
+        thread.start()
+        thread.join()
+    finally:
+        threading.stack_size(old_stack_size)
+        sys.setrecursionlimit(old_limit)
+    return result[0]
+
+def parse_seconds(tokens, stream_type, parser_type=RecursiveProgramParser):
+    def parse():
+        parser = parser_type(stream_type(tokens))
+        start = time.perf_counter()
+        parser.parse()
+        return time.perf_counter() - start, len(parser.get_operators())
+    return run_deep(parse)
+
+def bench_token_stream(operators=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), pop_front_max=10 ** 4):
+    print('%10s %10s %12s %12s' % ('operators', 'tokens', 'pop(0), s', 'cursor, s'))
+    for operators_n in operators:
+        tokens = make_program_tokens(operators_n)
+        pop_front = '-'
+        if operators_n <= pop_front_max:
+            seconds, parsed_n = parse_seconds(list(tokens), PopFrontTokenStream)
+            assert parsed_n == operators_n
+            pop_front = '%.3f' % seconds
+        seconds, parsed_n = parse_seconds(tokens, TokenStream)
+        assert parsed_n == operators_n
+        print('%10d %10d %12s %12.3f' % (operators_n, len(tokens), pop_front, seconds))
+
+def bench_tail_productions(operators=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), recursive_max=10 ** 5):
+    """ One block of all operators: the loops parse it at the default recursion limit """
+    print('%10s %12s %12s %8s' % ('operators', 'recursive, s', 'loops, s', 'speedup'))
+    for operators_n in operators:
+        tokens = make_program_tokens(operators_n, block_size=operators_n)
+        parser = ProgramRecursiveDescentParser(tokens)
+        start = time.perf_counter()
+        parser.parse()
+        seconds = time.perf_counter() - start
+        operators_list = parser.get_operators()
+        assert len(operators_list) == operators_n
+        if operators_n <= recursive_max:
+            recursive_seconds, parsed_n = parse_seconds(tokens, TokenStream)
+            assert parsed_n == operators_n
+            print('%10d %12.3f %12.3f %8.1f' % (operators_n, recursive_seconds, seconds, recursive_seconds / seconds))
+        else:
+            print('%10d %12s %12.3f %8s' % (operators_n, '-', seconds, '-'))
+
+def evaluate_with_eval(operators):
+    """ The original evaluation: every operator is compiled by eval with a copy of the variables """
+    variables = {}
+    for op in operators:
+        variables[op.lhs] = eval(' '.join(op.rhs).replace(' <> ', ' != '), dict(variables))
+    return variables
+
+def bench_evaluation(operators=(10 ** 3, 10 ** 4, 10 ** 5), eval_max=10 ** 4):
+    print('%10s %10s %12s %12s %8s' % ('operators', 'eval, s', 'compile, s', 'run, s', 'speedup'))
+    for operators_n in operators:
+        parser = ProgramRecursiveDescentParser(make_program_tokens(operators_n, block_size=operators_n))
+        parser.parse()
+        operators_list = parser.get_operators()
+        start = time.perf_counter()
+        program = Program.compile(operators_list)
+        compile_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        variables = program.run()
+        run_seconds = time.perf_counter() - start
+        if operators_n <= eval_max:
+            start = time.perf_counter()
+            expected = evaluate_with_eval(operators_list)
+            eval_seconds = time.perf_counter() - start
+            assert list(map(repr, variables.items())) == list(map(repr, expected.items()))
+            print('%10d %10.3f %12.3f %12.3f %8.1f' % (operators_n, eval_seconds, compile_seconds, run_seconds,
+                                                       eval_seconds / (compile_seconds + run_seconds)))
+        else:
+            print('%10d %10s %12.3f %12.3f %8s' % (operators_n, '-', compile_seconds, run_seconds, '-'))
+
+def make_program_text(operators_n, seed=0, block_size=1000):
+    """ A line per operator """
+    return ' '.join(make_program_tokens(operators_n, seed, block_size=block_size)).replace(' ; ', ' ;\n')
+
+def bench_incremental(operators=(10 ** 3, 10 ** 4, 10 ** 5), edits_n=20, seed=0):
+    """ One-line edits in the middle of the program: a new constant, an inserted operator and its deletion """
+    rng = random.Random(seed)
+    print('%10s %10s %10s %10s %10s %10s' % ('operators', 'full, s', 'build, s', 'edit, ms', 'evaluated', 'tokens'))
+    for operators_n in operators:
+        text = make_program_text(operators_n, seed, block_size=10 ** 4)
+        start = time.perf_counter()
+        parser = ProgramRecursiveDescentParser(text.split())
+        parser.parse()
+        Program.compile(parser.get_operators()).run()
+        full_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        program = IncrementalProgram(text)
+        build_seconds = time.perf_counter() - start
+        edit_seconds, evaluated = 0.0, 0
+        for i in range(edits_n):
+            if i % 3 == 2: # delete the inserted line
+                edit = (edit[0], edit[0] + len(edit[2]), '')
+            else:
+                line_begin = text.index('\n', rng.randrange(len(text) // 4, len(text) // 2)) + 1
+                line_end = text.index('\n', line_begin)
+                if i % 3 == 0: # id_k = ... ; -> id_k = <constant> ;
+                    begin = text.index('=', line_begin) + 2
+                    edit = (begin, line_end - 2, str(rng.randint(1, 9)))
+                else:
+                    edit = (line_begin, line_begin, 'id_{} = {} ;\n'.format(rng.randrange(operators_n), rng.randint(1, 9)))
+            start = time.perf_counter()
+            program.edit(*edit)
+            edit_seconds += time.perf_counter() - start
+            evaluated += program.last_evaluated
+            text = text[:edit[0]] + edit[2] + text[edit[1]:]
+        if operators_n <= 10 ** 4:
+            parser = ProgramRecursiveDescentParser(text.split())
+            parser.parse()
+            expected = Program.compile(parser.get_operators()).run()
+            assert list(map(repr, program.variables().items())) == list(map(repr, expected.items()))
+        print('%10d %10.3f %10.3f %10.3f %10.1f %10d' % (operators_n, full_seconds, build_seconds,
+                                                        edit_seconds * 1e3 / edits_n, evaluated / edits_n,
+                                                        program.tokens_n))
+
+if __name__ == '__main__':
+    bench_token_stream()
+    bench_tail_productions()
+    bench_evaluation()
+    bench_incremental()
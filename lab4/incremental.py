@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+""" Incremental reprocessing of a program after text edits.
+
+The program is kept as a token stream split into chunks of about CHUNK_TOKENS
+tokens, every chunk has its text and the token offsets relative to it, so an
+edit touches only the chunks around it. The separators '{', '}' and ';' split
+the tokens into runs of the other tokens, every run is an assignment. An edit
+re-lexes the tokens it touches, reparses the runs around them and checks the
+separators of the region against their neighbours and the brace depths,
+the rest of the program is kept.
+
+The assignments form a def-use graph: a variable read is bound to the last
+assignment of the variable before it. After an edit only the new assignments
+and the reads whose binding or input value changed are evaluated again.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+from main import ParserError, Program, ProgramRecursiveDescentParser, Var, BinOp
+from lexer import iter_tokens
+
+SEPARATORS = frozenset(('{', '}', ';'))
+START, END, RUN = 'start', 'end', 'run'
+# allowed kinds after a kind, the same grammar as ProgramRecursiveDescentParser
+NEXT_KINDS = {
+    START: ('{',),
+    '{': (RUN, '{'),
+    RUN: (';', '}'),
+    ';': (RUN, '{'),
+    '}': (';', '}', END),
+}
+CHUNK_TOKENS = 1024
+KEY_GAP = 1 << 32
+NOT_RUN = -1
+
+class EvalError(object):
+    """ Value of an assignment whose evaluation raised, the readers share it """
+    __slots__ = ('exc',)
+    def __init__(self, exc):
+        self.exc = exc
+
+class Chunk(object):
+    """ Text and tokens, the token offsets are relative to the chunk text.
+    depths are the brace depths after the tokens, runs are the run ids of the tokens or NOT_RUN.
+    All the chunks but the last end with a separator, so a run is never split.
+    """
+    __slots__ = ('text', 'tokens', 'starts', 'ends', 'depths', 'runs')
+    def __init__(self, text, tokens=None, starts=None, ends=None, depths=None, runs=None):
+        self.text = text
+        self.tokens = tokens or []
+        self.starts = starts or []
+        self.ends = ends or []
+        self.depths = depths or []
+        self.runs = runs or []
+    @classmethod
+    def merge(cls, chunks):
+        merged = cls('')
+        for chunk in chunks:
+            base = len(merged.text)
+            merged.text += chunk.text
+            merged.tokens += chunk.tokens
+            merged.starts += [s + base for s in chunk.starts]
+            merged.ends += [e + base for e in chunk.ends]
+            merged.depths += chunk.depths
+            merged.runs += chunk.runs
+        return merged
+    def split(self, size):
+        """ Chunks of at least size tokens ending with a separator, the last one may be smaller """
+        chunks, begin = [], 0
+        for i in range(size, len(self.tokens)):
+            if i - begin >= size and self.tokens[i - 1] in SEPARATORS:
+                chunks.append(self._slice(begin, i))
+                begin = i
+        chunks.append(self._slice(begin, len(self.tokens)))
+        return chunks
+    def _slice(self, begin, end):
+        text_begin = self.starts[begin] if begin else 0
+        text_end = self.starts[end] if end < len(self.tokens) else len(self.text)
+        return Chunk(self.text[text_begin:text_end], self.tokens[begin:end],
+                     [s - text_begin for s in self.starts[begin:end]], [e - text_begin for e in self.ends[begin:end]],
+                     self.depths[begin:end], self.runs[begin:end])
+
+def _kind(token):
+    return token if token in SEPARATORS else RUN
+
+def _read_variables(expr):
+    names, q = [], [expr]
+    while q:
+        node = q.pop()
+        if isinstance(node, BinOp):
+            q.append(node.right)
+            q.append(node.left)
+        elif isinstance(node, Var) and node.name not in names:
+            names.append(node.name)
+    return names
+
+def _same_value(a, b):
+    return type(a) is type(b) and (a is b or a == b)
+
+class IncrementalProgram(object):
+    """ Program text with incremental edit(begin, end, new_text), variables() as of the eval of all operators.
+    A syntax error of an edit is raised, the edit is still applied and the next one reprocesses the whole text.
+    """
+    def __init__(self, text):
+        self._reset(text)
+    def _reset(self, text):
+        self._chunks = [Chunk('')]
+        self._lengths = [0] # of the chunk texts
+        self._ops = {} # run id -> Bunch operator with key, reads, program, value
+        self._defs = {} # variable -> sorted [(key, run id)] of the assignments
+        self._uses = {} # variable -> sorted [(key, run id)] of the reads
+        self._errors = set()
+        self._next_run = 0
+        self._stale_text = None
+        self.last_evaluated = 0
+        self.edit(0, 0, text)
+    @property
+    def text(self):
+        if self._stale_text is not None:
+            return self._stale_text
+        return ''.join(chunk.text for chunk in self._chunks)
+    @property
+    def tokens_n(self):
+        return sum(len(chunk.tokens) for chunk in self._chunks)
+
+    def edit(self, begin, end, new_text):
+        """ Replace text[begin:end] by new_text """
+        if self._stale_text is not None:
+            text = self._stale_text
+            return self._reset(text[:begin] + new_text + text[end:])
+        chunks = self._chunks
+        bases = list(accumulate(self._lengths[:-1], initial=0))
+        ci, cj = bisect_right(bases, begin) - 1, bisect_right(bases, end) - 1
+        if ci and begin == bases[ci]: # the token before may end at begin
+            ci -= 1
+        while True:
+            try:
+                if self._edit_chunks(ci, cj, begin - bases[ci], end - bases[ci], new_text):
+                    return
+            except ParserError:
+                text = self.text
+                self._stale_text = text[:begin] + new_text + text[end:]
+                raise
+            cj += 1 # the region run continues in the next chunk
+
+    def _edit_chunks(self, ci, cj, begin, end, new_text):
+        """ Apply the edit to the merged chunks ci..cj, False if the region should take the next chunk too """
+        chunks = self._chunks
+        work = Chunk.merge(chunks[ci:cj + 1])
+        delta = len(new_text) - (end - begin)
+        text = work.text[:begin] + new_text + work.text[end:]
+        # the tokens touching the edit, they may merge with the new text
+        a, b = bisect_left(work.ends, begin), bisect_right(work.starts, end)
+        lo, hi = begin, end
+        if a < b:
+            lo, hi = min(begin, work.starts[a]), max(end, work.ends[b - 1])
+        while b < len(work.tokens) and work.starts[b] == hi: # the tokens without spaces may merge too
+            hi = work.ends[b]
+            b += 1
+        new_tokens = list(iter_tokens(text, lo, hi + delta))
+        tokens = work.tokens
+        left = a
+        while left > 0 and tokens[left - 1] not in SEPARATORS:
+            left -= 1
+        right = b
+        while right < len(tokens) and tokens[right] not in SEPARATORS:
+            right += 1
+        region = tokens[left:a] + [t.value for t in new_tokens] + tokens[b:right]
+        is_last = cj == len(chunks) - 1
+        if right == len(tokens) and not is_last and (not region or region[-1] not in SEPARATORS):
+            return False
+
+        prev_chunk = chunks[ci - 1] if ci else None
+        depth = work.depths[left - 1] if left else prev_chunk.depths[-1] if prev_chunk else 0
+        end_depth = work.depths[right - 1] if right else depth
+        prev_kind = _kind(tokens[left - 1]) if left else _kind(prev_chunk.tokens[-1]) if prev_chunk else START
+        next_kind = _kind(tokens[right]) if right < len(tokens) else END if is_last else _kind(chunks[cj + 1].tokens[0])
+        last_index = len(tokens) - (right - left) + len(region) - 1 if is_last else -1
+        depths = self._check_region(region, left, last_index, prev_kind, next_kind, depth, end_depth)
+        ops = self._parse_runs(region)
+
+        old_runs = set(work.runs[left:right])
+        old_runs.discard(NOT_RUN)
+        work.text = text
+        work.tokens[left:right] = region
+        work.starts[left:right] = work.starts[left:a] + [t.start for t in new_tokens] + [s + delta for s in work.starts[b:right]]
+        work.starts[left + len(region):] = [s + delta for s in work.starts[left + len(region):]]
+        work.ends[left:right] = work.ends[left:a] + [t.end for t in new_tokens] + [e + delta for e in work.ends[b:right]]
+        work.ends[left + len(region):] = [e + delta for e in work.ends[left + len(region):]]
+        work.depths[left:right] = depths
+        run_ids = [NOT_RUN] * len(region)
+        for op in ops:
+            op.run = self._next_run
+            self._next_run += 1
+            run_ids[op.begin:op.end] = [op.run] * (op.end - op.begin)
+        work.runs[left:right] = run_ids
+
+        lo = self._neighbour_key(work.runs, left - 1, ci - 1, -1)
+        hi = self._neighbour_key(work.runs, left + len(region), cj + 1, 1)
+        if work.tokens or not (prev_chunk or not is_last):
+            pieces = work.split(CHUNK_TOKENS)
+            chunks[ci:cj + 1] = pieces
+            self._lengths[ci:cj + 1] = [len(chunk.text) for chunk in pieces]
+        elif prev_chunk: # only spaces are left
+            prev_chunk.text += work.text
+            del chunks[ci:cj + 1]
+            self._lengths[ci - 1:cj + 1] = [len(prev_chunk.text)]
+        else:
+            del chunks[ci:cj + 1]
+            chunks[ci] = Chunk.merge((work, chunks[ci]))
+            self._lengths[ci:cj + 2] = [len(chunks[ci].text)]
+        self._update_graph(old_runs, ops, lo, hi)
+        return True
+
+    def _check_region(self, region, left, last_index, prev_kind, next_kind, depth, end_depth):
+        """ Depths of the region tokens, ParserError if the separators do not fit the grammar """
+        depths = [0] * len(region)
+        for i, token in enumerate(region):
+            kind = _kind(token)
+            if (kind != RUN or prev_kind != RUN) and kind not in NEXT_KINDS[prev_kind]:
+                raise ParserError('unexpected "{}" after "{}"', None, token, prev_kind)
+            depth += 1 if token == '{' else -1 if token == '}' else 0
+            if depth < 1 and left + i != last_index:
+                raise ParserError('unbalanced "}}" at token {} of the chunk', None, left + i)
+            depths[i] = depth
+            prev_kind = kind
+        if (next_kind != RUN or prev_kind != RUN) and next_kind not in NEXT_KINDS[prev_kind]:
+            raise ParserError('unexpected "{}" after "{}"', None, next_kind, prev_kind)
+        if depth != end_depth or (next_kind == END and depth != 0):
+            raise ParserError('unbalanced braces')
+        return depths
+
+    def _parse_runs(self, region):
+        ops, i = [], 0
+        while i < len(region):
+            if region[i] in SEPARATORS:
+                i += 1
+                continue
+            j = i
+            while j < len(region) and region[j] not in SEPARATORS:
+                j += 1
+            op = ProgramRecursiveDescentParser(region[i:j]).parse_operator()
+            op.begin, op.end = i, j
+            ops.append(op)
+            i = j
+        return ops
+
+    def _neighbour_key(self, runs, i, ci, step):
+        """ Key of the first run from runs[i] in the step direction, then in the chunks from ci """
+        while True:
+            while 0 <= i < len(runs):
+                if runs[i] != NOT_RUN:
+                    return self._ops[runs[i]].key
+                i += step
+            if not 0 <= ci < len(self._chunks):
+                return None
+            runs = self._chunks[ci].runs
+            i = len(runs) - 1 if step < 0 else 0
+            ci += step
+
+    def _relabel(self):
+        key = 0
+        for chunk in self._chunks:
+            prev = NOT_RUN
+            for run in chunk.runs:
+                if run != NOT_RUN and run != prev:
+                    key += KEY_GAP
+                    self._ops[run].key = key
+                prev = run
+        for index in (self._defs, self._uses):
+            for var, entries in index.items():
+                index[var] = sorted((self._ops[run].key, run) for _, run in entries)
+
+    def _update_graph(self, old_runs, ops, lo, hi):
+        dirty = []
+        for run in old_runs:
+            op = self._ops.pop(run)
+            self._errors.discard(run)
+            self._remove_entry(self._defs, op.lhs, op.key, run)
+            for var in op.reads:
+                self._remove_entry(self._uses, var, op.key, run)
+            self._mark_reads(dirty, op.lhs, op.key)
+        lo = lo if lo is not None else 0
+        step = KEY_GAP if hi is None else (hi - lo) // (len(ops) + 1)
+        for i, op in enumerate(ops):
+            op.key = lo + (i + 1) * max(step, 1)
+            op.reads = _read_variables(op.expr)
+            op.program = Program.compile([op])
+            op.value = None
+            self._ops[op.run] = op
+        if ops and step == 0:
+            self._relabel()
+            dirty = [(self._ops[run].key, run) for _, run in dirty if run in self._ops]
+            heapq.heapify(dirty)
+        for op in ops:
+            self._insert_entry(self._defs, op.lhs, op.key, op.run)
+            for var in op.reads:
+                self._insert_entry(self._uses, var, op.key, op.run)
+            self._mark_reads(dirty, op.lhs, op.key)
+            heapq.heappush(dirty, (op.key, op.run))
+        self._evaluate(dirty)
+
+    @staticmethod
+    def _insert_entry(index, var, key, run):
+        entries = index.setdefault(var, [])
+        entries.insert(bisect_left(entries, (key, run)), (key, run))
+    @staticmethod
+    def _remove_entry(index, var, key, run):
+        entries = index[var]
+        del entries[bisect_left(entries, (key, run))]
+        if not entries:
+            del index[var]
+
+    def _reaching_def(self, var, key):
+        entries = self._defs.get(var, ())
+        k = bisect_left(entries, (key,))
+        return entries[k - 1][1] if k else None
+
+    def _mark_reads(self, dirty, var, key):
+        """ The reads of var bound to its assignment at key """
+        uses = self._uses.get(var, ())
+        defs = self._defs.get(var, ())
+        k = bisect_left(defs, (key + 1,))
+        next_key = defs[k][0] if k < len(defs) else None
+        for i in range(bisect_left(uses, (key + 1,)), len(uses)):
+            use_key, run = uses[i]
+            if next_key is not None and use_key > next_key:
+                break
+            heapq.heappush(dirty, (use_key, run))
+
+    def _evaluate(self, dirty):
+        """ Evaluate the dirty runs in the program order, the changed values make their readers dirty """
+        done = set()
+        self.last_evaluated = 0
+        while dirty:
+            key, run = heapq.heappop(dirty)
+            op = self._ops.get(run)
+            if op is None or op.key != key or run in done:
+                continue
+            done.add(run)
+            self.last_evaluated += 1
+            inputs, value = {}, None
+            for var in op.reads:
+                def_run = self._reaching_def(var, key)
+                if def_run is not None:
+                    inputs[var] = self._ops[def_run].value
+                    if isinstance(inputs[var], EvalError):
+                        value = inputs[var]
+            if value is None:
+                try:
+                    value = op.program.run(inputs)[op.lhs]
+                except Exception as e:
+                    value = EvalError(e)
+            if isinstance(value, EvalError):
+                self._errors.add(run)
+            else:
+                self._errors.discard(run)
+            if not _same_value(op.value, value):
+                op.value = value
+                self._mark_reads(dirty, op.lhs, key)
+
+    def variables(self):
+        """ {variable: value} in the order of the first assignment, raises the first evaluation error """
+        if self._stale_text is not None:
+            raise ParserError('the last edit has a syntax error')
+        if self._errors:
+            raise self._ops[min(self._errors, key=lambda run: self._ops[run].key)].value.exc
+        return {var: self._ops[entries[-1][1]].value
+                for var, entries in sorted(self._defs.items(), key=lambda item: item[1][0][0])}
+
+def diff_edit(old, new):
+    """ (begin, end, new_text) turning old into new: the text between their common prefix and suffix """
+    lo, hi = 0, min(len(old), len(new))
+    while lo < hi: # the slices are compared by memcmp
+        mid = (lo + hi + 1) // 2
+        if old[:mid] == new[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+    lo, hi = 0, min(len(old), len(new)) - prefix
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[len(old) - mid:] == new[len(new) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return prefix, len(old) - lo, new[prefix:len(new) - lo]
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import sys
+    import time
+    argparser = argparse.ArgumentParser(description='Evaluate the program file again on every change of it')
+    argparser.add_argument('program_file')
+    argparser.add_argument('--interval', type=float, default=0.5, help='seconds between the checks of the file')
+    args = argparser.parse_args()
+
+    program, mtime = None, None
+    while True:
+        stat_mtime = os.stat(args.program_file).st_mtime_ns
+        if stat_mtime != mtime:
+            mtime = stat_mtime
+            with open(args.program_file) as f:
+                text = f.read()
+            start = time.perf_counter()
+            try:
+                if program is None:
+                    program = IncrementalProgram(text)
+                else:
+                    program.edit(*diff_edit(program.text, text))
+                variables = program.variables()
+            except Exception as e:
+                if program is None:
+                    sys.exit(e)
+                print('Error: {}'.format(e))
+            else:
+                print('Variables ({} evaluated in {:.3f}s):'.format(program.last_evaluated, time.perf_counter() - start))
+                for var, val in variables.items():
+                    print('{} = {}'.format(var, val))
+            sys.stdout.flush()
+        time.sleep(args.interval)
@@ -1,109 +1,247 @@
 #!/usr/bin/env python3
+import operator
+import os
+import sys
+from array import array
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from lexer import iter_tokens, map_file
 
 class Bunch(object):
     def __init__(self, **kwds):
         self.__dict__.update(kwds)
 
+ERROR_WINDOW = 5
+REL_OPS = frozenset(('==', '<=', '<>', '>=', '<', '>'))
+ADD_OPS = frozenset(('+', '-'))
+MUL_OPS = frozenset(('*', '/'))
+
+class Const(object):
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+
+class Var(object):
+    __slots__ = ('name',)
+    def __init__(self, name):
+        self.name = name
+
+class BinOp(object):
+    __slots__ = ('op', 'left', 'right')
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
 class ParserError(Exception):
-    pass
+    """ The message is built when printed only: the parser raises and catches
+    ParserError while trying the alternatives.
+    """
+    def __init__(self, text, tokens=None, *args):
+        super().__init__(text)
+        self._text = text
+        self._tokens = tokens
+        self._args = args
+    def __str__(self):
+        text = self._text.format(*self._args)
+        if self._tokens is None:
+            return text
+        top = self._tokens.peek()
+        return 'err: "{}", top_token="{}", tokens="{}"'.format(text, top if top is not None else '', self._tokens.window())
+
+class TokenStream(object):
+    """ Token list with a cursor, peek and advance are O(1) """
+    __slots__ = ('tokens', 'pos')
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+    def advance(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+    def window(self, radius=ERROR_WINDOW):
+        """ The tokens around the cursor, the current one in brackets """
+        begin, end = max(0, self.pos - radius), min(len(self.tokens), self.pos + radius + 1)
+        tokens = list(self.tokens[begin:self.pos])
+        if self.pos < len(self.tokens):
+            tokens.append('[{}]'.format(self.tokens[self.pos]))
+        else:
+            tokens.append('[]')
+        tokens.extend(self.tokens[self.pos + 1:end])
+        return '{}{}{}'.format('... ' if begin else '', ' '.join(tokens), ' ...' if end < len(self.tokens) else '')
 
 class ProgramRecursiveDescentParser(object):
     def __init__(self, tokens):
-        self._tokens = tokens
+        self._tokens = tokens if isinstance(tokens, TokenStream) else TokenStream(tokens)
         self._error = None
         self._operators = []
     def get_operators(self):
         return tuple(self._operators)
-    def _err(self, text):
-        raise ParserError('err: "{}", top_token="{}", tokens="{}"'.format(text, self._tokens[0] if self._tokens else '', self._tokens))
+    def _err(self, text, *args):
+        raise ParserError(text, self._tokens, *args)
     def _is_on_top(self, term):
-        return self._tokens and self._tokens[0] == term
+        return self._tokens.peek() == term
     def _match_term(self, term):
-        if self._is_on_top(term):
-            return self._tokens.pop(0)
-        self._err("term {} doesnt match with current stack top token".format(term))
+        if self._tokens.peek() == term:
+            return self._tokens.advance()
+        self._err("term {} doesnt match with current stack top token", term)
     def _try_match(self, matcher):
-        return self._tokens.pop(0) if self._tokens and matcher(self._tokens[0]) else None
-    def _match(self, matcher):
-        return self._try_match(matcher) or self._err('cant match by matcher {}'.format(matcher))
+        token = self._tokens.peek()
+        return self._tokens.advance() if token is not None and matcher(token) else None
     def _try_parse_id(self):
         return self._try_match(lambda t: t.startswith('id_'))
     def _parse_id(self):
         return self._try_parse_id() or self._err('cant parse valid identificator')
     def _try_parse_constant(self):
         return self._try_match(lambda t: t.isdigit())
-    def _parse_factor(self):
+    def _parse_factor(self, rhs):
         if self._is_on_top('('):
-            yield self._match_term('(')
-            yield from self._parse_ar_expr()
-            yield self._match_term(')')
-        else:
-            yield self._try_parse_id() or self._try_parse_constant() or self._err('invalid factor')
-    def _parse_mul_op(self):
-        return self._match(lambda t: t in ('*', '/'))
-    def _parse_term_rest(self):
-        yield self._parse_mul_op()
-        yield from self._parse_factor()
-        try:
-            yield from self._parse_term_rest()
-        except ParserError:
-            pass
-    def _parse_term(self):
-        yield from self._parse_factor()
-        try:
-            yield from self._parse_term_rest()
-        except ParserError:
-            pass
-    def _parse_add_op(self):
-        return self._match(lambda t: t in ('+', '-'))
-    def _parse_ar_expr_rest(self):
-        yield self._parse_add_op()
-        yield from self._parse_term()
-        try:
-            yield from self._parse_ar_expr_rest()
-        except ParserError:
-            pass
-    def _parse_ar_expr(self):
-        yield from self._parse_term()
-        try:
-            yield from self._parse_ar_expr_rest()
-        except ParserError:
-            pass
+            rhs.append(self._match_term('('))
+            node = self._parse_ar_expr(rhs)
+            rhs.append(self._match_term(')'))
+            return node
+        token = self._try_parse_id()
+        if token:
+            rhs.append(token)
+            return Var(token)
+        token = self._try_parse_constant() or self._err('invalid factor')
+        rhs.append(token)
+        return Const(int(token))
+    def _parse_term(self, rhs):
+        tokens = self._tokens
+        node = self._parse_factor(rhs)
+        while tokens.peek() in MUL_OPS: # term rest
+            op = tokens.advance()
+            rhs.append(op)
+            node = BinOp(op, node, self._parse_factor(rhs))
+        return node
+    def _parse_ar_expr(self, rhs):
+        tokens = self._tokens
+        node = self._parse_term(rhs)
+        while tokens.peek() in ADD_OPS: # ar expr rest
+            op = tokens.advance()
+            rhs.append(op)
+            node = BinOp(op, node, self._parse_term(rhs))
+        return node
     def _try_parse_rel_op(self):
-        return self._tokens.pop(0) if self._tokens and self._tokens[0] in ('==', '<=', '<>', '>=', '<', '>') else None
-    def _parse_expr(self):
-        yield from self._parse_ar_expr()
+        return self._tokens.advance() if self._tokens.peek() in REL_OPS else None
+    def _parse_expr(self, rhs):
+        node = self._parse_ar_expr(rhs)
         rel_res = self._try_parse_rel_op()
         if rel_res:
-            yield rel_res
-            yield from self._parse_ar_expr()
+            rhs.append(rel_res)
+            node = BinOp(rel_res, node, self._parse_ar_expr(rhs))
+        return node
     def _parse_op(self):
         if self._is_on_top('{'):
             return self._parse_block()
         lhs = self._parse_id()
         self._match_term('=')
-        rhs = tuple(self._parse_expr())
-        self._operators.append(Bunch(lhs=lhs, rhs=rhs))
-    def _parse_op_tail(self):
-        try:
-            self._match_term(';')
-            self._parse_op()
-            self._parse_op_tail()
-        except ParserError:
-            pass
+        rhs = []
+        expr = self._parse_expr(rhs)
+        self._operators.append(Bunch(lhs=lhs, rhs=tuple(rhs), expr=expr))
     def _parse_op_list(self):
+        tokens = self._tokens
         self._parse_op()
-        self._parse_op_tail()
+        while tokens.peek() == ';': # op tail
+            tokens.advance()
+            self._parse_op()
     def _parse_block(self):
         self._match_term('{')
         self._parse_op_list()
         self._match_term('}')
     def parse(self):
-        return self._parse_block()
+        """ The block of all the tokens, as the incremental parser accepts """
+        self._parse_block()
+        if self._tokens.peek() is not None:
+            self._err('unexpected token after the block')
+    def parse_operator(self):
+        """ An assignment of all the tokens """
+        self._parse_op()
+        if self._tokens.peek() is not None:
+            self._err('unexpected token after the operator')
+        return self._operators[-1]
+
+# opcodes, the binary operators are the BINARY_OPS indices
+LOAD_CONST, LOAD_VAR, STORE = -1, -2, -3
+BINARY_OPS = ('+', '-', '*', '/', '==', '<>', '<', '<=', '>', '>=')
+BINARY_FUNCS = (operator.add, operator.sub, operator.mul, operator.truediv, operator.eq, operator.ne,
+                operator.lt, operator.le, operator.gt, operator.ge)
+UNDEFINED = object()
+
+class Program(object):
+    """ Stack bytecode of the operators: (opcode, arg) pairs in one int array,
+    the variables are resolved to slots at the compile time.
+    """
+    def __init__(self, code, consts, names, assigned_n):
+        self.code = code
+        self.consts = consts
+        self.names = names # the assigned variables first, in the order of the first assignment
+        self.assigned_n = assigned_n
+    @classmethod
+    def compile(cls, operators):
+        slots, consts, const_slots = {}, [], {}
+        for op in operators:
+            slots.setdefault(op.lhs, len(slots))
+        assigned_n = len(slots)
+        binary_opcodes = {op: i for i, op in enumerate(BINARY_OPS)}
+        code = array('i')
+        for op in operators:
+            q = [op.expr] # post order without recursion, a long + chain is a deep left tree
+            while q:
+                node = q.pop()
+                if isinstance(node, BinOp):
+                    q.append(binary_opcodes[node.op])
+                    q.append(node.right)
+                    q.append(node.left)
+                elif isinstance(node, int):
+                    code.extend((node, 0))
+                elif isinstance(node, Var):
+                    code.extend((LOAD_VAR, slots.setdefault(node.name, len(slots))))
+                else:
+                    k = const_slots.get(node.value)
+                    if k is None:
+                        k = const_slots[node.value] = len(consts)
+                        consts.append(node.value)
+                    code.extend((LOAD_CONST, k))
+            code.extend((STORE, slots[op.lhs]))
+        names = [None] * len(slots)
+        for name, slot in slots.items():
+            names[slot] = name
+        return cls(code, tuple(consts), tuple(names), assigned_n)
+    def run(self, inputs=None):
+        """ {variable: value} in the order of the first assignment,
+        inputs are the values of the variables before the program
+        """
+        values = [UNDEFINED] * len(self.names)
+        if inputs:
+            for slot, name in enumerate(self.names):
+                values[slot] = inputs.get(name, UNDEFINED)
+        consts, names, funcs = self.consts, self.names, BINARY_FUNCS
+        stack = []
+        push, pop = stack.append, stack.pop
+        code = self.code
+        for i in range(0, len(code), 2):
+            opcode = code[i]
+            if opcode == LOAD_VAR:
+                value = values[code[i + 1]]
+                if value is UNDEFINED:
+                    raise NameError("name '{}' is not defined".format(names[code[i + 1]]))
+                push(value)
+            elif opcode == LOAD_CONST:
+                push(consts[code[i + 1]])
+            elif opcode == STORE:
+                values[code[i + 1]] = pop()
+            else:
+                right = pop()
+                stack[-1] = funcs[opcode](stack[-1], right)
+        return {names[i]: values[i] for i in range(self.assigned_n)}
 
 if __name__ == '__main__':
-    import sys
-    tokens = sys.stdin.read().split()
+    source = map_file(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin.read()
+    tokens = [token.value for token in iter_tokens(source)]
     parser = ProgramRecursiveDescentParser(tokens)
     try:
         parser.parse()
@@ -111,10 +249,7 @@ if __name__ == '__main__':
         #import traceback; traceback.print_exc()
         sys.exit(e)
 
-    variables = {}
-    for op in parser.get_operators():
-        assert isinstance(op.lhs, str) and op.rhs
-        variables[op.lhs] = eval(' '.join(op.rhs).replace(' <> ', ' != '), dict(variables))
+    variables = Program.compile(parser.get_operators()).run()
     print('Variables:')
     for var, val in variables.items():
         print('{} = {}'.format(var, val))
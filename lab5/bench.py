@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+""" Benchmarks for the operator precedence parser on generated programs """
+import random
+import time
+
+from gram import Gram, test_grammar, parse_rules, EOF
+from parser import PrecedenceTable, PrecedenceParser, make_core_grammar, tokenize
+from parser import CORE_AXIOM, EOF_TOKEN, PREC_REL_EQ, PREC_REL_LT, PREC_REL_GT
+
+REL_OPS = ('<', '<=', '==', '<>', '>', '>=')
+
+def make_program(operators_n, seed=0, max_operands=4, block_size=1000):
+    """ Text of a program of operators_n assignments, every block_size of them in a nested block """
+    rng = random.Random(seed)
+    def ar_expr(n, depth=0):
+        tokens = []
+        for j in range(n):
+            if j:
+                tokens.append(rng.choice('+-*/'))
+            if depth < 2 and rng.random() < 0.1:
+                tokens += ['('] + ar_expr(rng.randint(1, max_operands), depth + 1) + [')']
+            else:
+                tokens.append('id_{}'.format(rng.randrange(operators_n)) if rng.random() < 0.5 else str(rng.randint(0, 9)))
+        return tokens
+    tokens = ['{']
+    for i in range(operators_n):
+        if i:
+            tokens.append(';')
+            if i % block_size == 0:
+                tokens.append('{')
+        tokens += ['id_{}'.format(i), '='] + ar_expr(rng.randint(1, max_operands))
+        if rng.random() < 0.2:
+            tokens += [rng.choice(REL_OPS)] + ar_expr(rng.randint(1, max_operands))
+    tokens.extend('}' * (1 + (operators_n - 1) // block_size))
+    return ' '.join(tokens)
+
+class LegacyPrecedenceParser(PrecedenceParser):
+    """ The original parse: a scan of the rules on every reduce, tokens.pop(0) and
+    the terminals of the stack collected again for every pivot search, without the stack prints
+    """
+    def _search_rule_pivot_to_reduce(self, stack):
+        stack_terminals = [(i, e) for i, e in enumerate(stack) if e != CORE_AXIOM]
+        for i in reversed(range(len(stack_terminals))):
+            if i == 0:
+                raise ValueError('cant find rule to reduce in the stack: {}'.format(stack))
+            (prev_i, prev), (_, cur) = stack_terminals[i-1:i+1]
+            prec_rel = self._pt[prev, cur]
+            assert prec_rel is not None
+            if prec_rel == PREC_REL_EQ:
+                continue
+            return prev_i + 1
+    def parse(self, tokens):
+        tokens = list(tokens)
+        stack, res, rpns, cur_rpn = [EOF], [], [], []
+        while not (stack == [EOF, CORE_AXIOM] and tokens == [EOF_TOKEN]):
+            stack_top, next_token = stack[-1], tokens[0]
+            if stack_top == CORE_AXIOM:
+                stack_top = stack[-2]
+            precedence_relation = self._pt[stack_top, next_token.terminal]
+            if precedence_relation is None:
+                raise ValueError('cant parse grammar')
+            if precedence_relation in (PREC_REL_LT, PREC_REL_EQ): # shift
+                if next_token.is_value:
+                    cur_rpn.append(next_token.value)
+                stack.append(tokens.pop(0).terminal)
+                continue
+            pivot_i = self._search_rule_pivot_to_reduce(stack)
+            pivot = stack[pivot_i:]
+            del stack[pivot_i:]
+            reduce_rules = [r for r in self._core_gram.rules if r.rhs == pivot]
+            assert len(reduce_rules) == 1, reduce_rules
+            reduce_rule = reduce_rules[0]
+            res.append(reduce_rule.index)
+            stack.append(CORE_AXIOM)
+            reduce_rule_operators = [t for t in reduce_rule.rhs if self._core_gram.is_operator(t)]
+            if reduce_rule_operators:
+                cur_rpn.append(reduce_rule_operators[0])
+                if reduce_rule_operators[0] == '=':
+                    rpns.append(cur_rpn)
+                    cur_rpn = []
+        return res, rpns
+
+def make_grammar(levels, atoms_n, level_operators=2):
+    """ Expression grammar of the levels of left-associative operators over atoms_n atoms and parentheses """
+    operators = [['o{}_{}'.format(level, j) for j in range(level_operators)] for level in range(levels)]
+    atoms = ['a{}'.format(i) for i in range(atoms_n)]
+    rules = ['E{0} -> '.format(level) + ' | '.join(['E{0} {1} E{2}'.format(level, op, level + 1) for op in ops] +
+                                                   ['E{}'.format(level + 1)])
+             for level, ops in enumerate(operators)]
+    rules.append('E{} -> ( E0 ) | '.format(levels) + ' | '.join(atoms))
+    all_operators = set(op for ops in operators for op in ops)
+    return Gram(operators=all_operators, terminals=all_operators | set(atoms) | set(('(', ')', EOF)),
+                start_symbol='E0', rules=parse_rules(*rules))
+
+def legacy_precedent_terms_set(gram, nonterm, rhs_filter):
+    lookuped_nonterms = set((nonterm,))
+    q = [nonterm]
+    res = set()
+    while q:
+        lhs = q.pop(0)
+        for rule in (r for r in gram.rules if r.lhs == lhs):
+            rhs = rhs_filter(rule.rhs)
+            if gram.is_term(rhs[0]):
+                res.add(rhs[0])
+                continue
+            if len(rhs) >= 2 and gram.is_term(rhs[1]):
+                res.add(rhs[1])
+            if rhs[0] not in lookuped_nonterms:
+                lookuped_nonterms.add(rhs[0])
+                q.append(rhs[0])
+    return res
+
+def legacy_table(gram):
+    """ The original construction: a breadth-first search over all the rules for every init and tail set """
+    init_set = lambda nonterm: legacy_precedent_terms_set(gram, nonterm, lambda rhs: rhs)
+    tail_set = lambda nonterm: legacy_precedent_terms_set(gram, nonterm, lambda rhs: list(reversed(rhs)))
+    pt = PrecedenceTable(gram)
+    for rule in gram.rules:
+        for i in range(len(rule.rhs)):
+            rhs = rule.rhs[i:i+3]
+            if len(rhs) == 1:
+                continue
+            if gram.is_term(rhs[0]):
+                if gram.is_term(rhs[1]):
+                    pt[rhs[0], rhs[1]] = PREC_REL_EQ
+                    continue
+                if len(rhs) == 3:
+                    pt[rhs[0], rhs[2]] = PREC_REL_EQ
+                for term in init_set(rhs[1]):
+                    pt[rhs[0], term] = PREC_REL_LT
+                continue
+            for term in tail_set(rhs[0]):
+                pt[term, rhs[1]] = PREC_REL_GT
+    for term in init_set(gram.start_symbol):
+        pt[EOF, term] = PREC_REL_LT
+    for term in tail_set(gram.start_symbol):
+        pt[term, EOF] = PREC_REL_GT
+    return pt
+
+def bench_table(grammars=((10, 100), (10, 1000), (10, 3000), (100, 1000), (1000, 10)), legacy_max_rules=1500):
+    print('%8s %8s %8s %12s %12s' % ('levels', 'atoms', 'rules', 'legacy s', 's'))
+    for levels, atoms_n in grammars:
+        gram = make_grammar(levels, atoms_n)
+        start = time.perf_counter()
+        pt = PrecedenceTable.from_grammar(gram)
+        seconds = time.perf_counter() - start
+        legacy = '-'
+        if len(gram.rules) <= legacy_max_rules:
+            start = time.perf_counter()
+            assert legacy_table(gram)._pt == pt._pt
+            legacy = '%.3f' % (time.perf_counter() - start)
+        print('%8d %8d %8d %12s %12.3f' % (levels, atoms_n, len(gram.rules), legacy, seconds))
+
+def bench_parser(operators=(10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5), legacy_max=10 ** 3):
+    pt = PrecedenceTable.from_grammar(test_grammar)
+    core_gram = make_core_grammar(test_grammar)
+    parser = PrecedenceParser(pt, core_gram)
+    legacy_parser = LegacyPrecedenceParser(pt, core_gram)
+    print('%10s %10s %14s %14s' % ('operators', 'tokens', 'legacy tok/s', 'tok/s'))
+    for operators_n in operators:
+        tokens = list(tokenize(make_program(operators_n)))
+        start = time.perf_counter()
+        result = parser.parse(tokens)
+        seconds = time.perf_counter() - start
+        legacy = '-'
+        if operators_n <= legacy_max:
+            start = time.perf_counter()
+            assert legacy_parser.parse(tokens) == result
+            legacy = '%.0f' % (len(tokens) / (time.perf_counter() - start))
+        print('%10d %10d %14s %14.0f' % (operators_n, len(tokens), legacy, len(tokens) / seconds))
+
+if __name__ == '__main__':
+    bench_table()
+    bench_parser()
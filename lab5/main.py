@@ -2,15 +2,24 @@
 
 if __name__ == '__main__':
     from gram import test_grammar
+    import argparse
+    argparser = argparse.ArgumentParser(description='Operator precedence parser of the test grammar, the program is stdin')
+    argparser.add_argument('--no-cache', action='store_true', help='build the tables without reading or writing the cache')
+    argparser.add_argument('--cache-dir', help='directory of the cached tables, ~/.cache/precedence by default')
+    args = argparser.parse_args()
+
     for i, rule in enumerate(test_grammar.rules):
         print('rule #{}: {} -> {}'.format(i, rule.lhs, ' '.join(rule.rhs)))
     print('')
 
     from parser import PrecedenceTable, PrecedenceParser
-    from parser import make_core_grammar, tokenize
-    pt = PrecedenceTable.from_grammar(test_grammar)
+    from parser import make_core_grammar, cached_reduce_index, tokenize
+    pt = PrecedenceTable.from_grammar(test_grammar) if args.no_cache else \
+        PrecedenceTable.from_grammar_cached(test_grammar, args.cache_dir)
     pt.dump()
-    parser = PrecedenceParser(pt, make_core_grammar(test_grammar))
+    core_gram = make_core_grammar(test_grammar)
+    reduce_index = None if args.no_cache else cached_reduce_index(test_grammar, core_gram, args.cache_dir)
+    parser = PrecedenceParser(pt, core_gram, verbose=True, reduce_index=reduce_index)
     from sys import stdin
     parse_rules, rpns = parser.parse(list(tokenize(stdin.read())))
     print('parse rules: {}'.format(parse_rules))
@@ -4,36 +4,60 @@ class Bunch:
     def __repr__(self):
         return self.__dict__.__repr__()
 
+import os
+import sys
+from array import array
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from lexer import EOF_TOKEN, iter_tokens
 from gram import EOF
-EOF_TOKEN = Bunch(kind=EOF, value='', is_value=False)
+assert EOF_TOKEN.terminal == EOF
 CORE_AXIOM = 'S'
 PREC_REL_LT = '<-'
 PREC_REL_GT = '->'
 PREC_REL_EQ = '='
+# the relations in the matrices of the tables, the values of CompactPrecedenceTable.VAL_* in lab6
+PREC_REL_CODES = {PREC_REL_LT: -1, PREC_REL_EQ: 0, PREC_REL_GT: 1}
+NO_PREC_REL_CODE = -2
 
-def get_precedent_terms_set(gram, nonterm, rhs_filter):
-    lookuped_nonterms = set((nonterm,))
-    q = [nonterm]
-    res = set()
-    while q:
-        lhs = q.pop(0)
-        for rule in (r for r in gram.rules if r.lhs == lhs):
+def get_init_and_tail_sets(gram):
+    """ Terminals tuple and the bitsets of the leading and the trailing terminals of the nonterminals,
+    bit i of a bitset is terminals[i]. One worklist fixpoint per direction.
+    """
+    terminals = tuple(sorted(gram.terminals))
+    bits = {t: 1 << i for i, t in enumerate(terminals)}
+    def fixpoint(rhs_filter):
+        sets = {}
+        including = {} # nonterminal -> the nonterminals whose sets include its set
+        for rule in gram.rules:
             rhs = rhs_filter(rule.rhs)
+            s = sets.get(rule.lhs, 0)
             if gram.is_term(rhs[0]):
-                res.add(rhs[0])
-                continue
-            assert gram.is_nonterm(rhs[0])
-            if len(rhs) >= 2 and gram.is_term(rhs[1]):
-                res.add(rhs[1])
-            if rhs[0] not in lookuped_nonterms:
-                lookuped_nonterms.add(rhs[0])
-                q.append(rhs[0])
-    return res
+                s |= bits[rhs[0]]
+            else:
+                assert gram.is_nonterm(rhs[0])
+                if len(rhs) >= 2 and gram.is_term(rhs[1]):
+                    s |= bits[rhs[1]]
+                including.setdefault(rhs[0], set()).add(rule.lhs)
+            sets[rule.lhs] = s
+        q = list(sets)
+        while q:
+            nonterm = q.pop()
+            for lhs in including.get(nonterm, ()):
+                s = sets[lhs] | sets.get(nonterm, 0)
+                if s != sets[lhs]:
+                    sets[lhs] = s
+                    q.append(lhs)
+        return sets
+    return terminals, fixpoint(lambda rhs: rhs), fixpoint(lambda rhs: rhs[::-1])
 
-def get_init_set(gram, nonterm):
-    return get_precedent_terms_set(gram, nonterm, lambda rhs: rhs)
-def get_tail_set(gram, nonterm):
-    return get_precedent_terms_set(gram, nonterm, lambda rhs: list(reversed(rhs)))
+def bits_to_terms(terminals, bitset):
+    res = []
+    while bitset:
+        low = bitset & -bitset
+        res.append(terminals[low.bit_length() - 1])
+        bitset ^= low
+    return res
 
 class PrecedenceTable(object):
     def __init__(self, gram):
@@ -46,6 +70,14 @@ class PrecedenceTable(object):
         if self._pt[k1].get(k2, v) != v:
             raise ValueError('invalid operator precedence grammar')
         self._pt[k1][k2] = v
+    def set_row(self, k1, k2s, v):
+        row = self._pt.setdefault(k1, {})
+        for k2 in k2s:
+            if row.setdefault(k2, v) != v:
+                raise ValueError('invalid operator precedence grammar')
+    def set_column(self, k1s, k2, v):
+        for k1 in k1s:
+            self[k1, k2] = v
     def __getitem__(self, k):
         if self._pt.get(k[0]) is None:
             return None
@@ -66,6 +98,9 @@ class PrecedenceTable(object):
     @classmethod
     def from_grammar(cls, gram):
         pt = cls(gram)
+        terminals, init_sets, tail_sets = get_init_and_tail_sets(gram)
+        init_sets = {nonterm: bits_to_terms(terminals, s) for nonterm, s in init_sets.items()}
+        tail_sets = {nonterm: bits_to_terms(terminals, s) for nonterm, s in tail_sets.items()}
         for rule in gram.rules:
             for i in range(len(rule.rhs)):
                 rhs = rule.rhs[i:i+3]
@@ -79,61 +114,100 @@ class PrecedenceTable(object):
                     if len(rhs) == 3:
                         assert gram.is_term(rhs[2])
                         pt[rhs[0], rhs[2]] = PREC_REL_EQ
-                    for term in get_init_set(gram, rhs[1]):
-                        pt[rhs[0], term] = PREC_REL_LT
+                    pt.set_row(rhs[0], init_sets.get(rhs[1], ()), PREC_REL_LT)
                     continue
                 assert gram.is_nonterm(rhs[0]) and gram.is_term(rhs[1]), rhs
-                for term in get_tail_set(gram, rhs[0]):
-                    pt[term, rhs[1]] = PREC_REL_GT
+                pt.set_column(tail_sets.get(rhs[0], ()), rhs[1], PREC_REL_GT)
 
-        for term in get_init_set(gram, gram.start_symbol):
-            pt[EOF, term] = PREC_REL_LT
-        for term in get_tail_set(gram, gram.start_symbol):
-            pt[term, EOF] = PREC_REL_GT
+        pt.set_row(EOF, init_sets.get(gram.start_symbol, ()), PREC_REL_LT)
+        pt.set_column(tail_sets.get(gram.start_symbol, ()), EOF, PREC_REL_GT)
 
         return pt
 
+    def to_matrix(self):
+        """ Row-major array('b') of the relation codes, the rows and the columns are the sorted terminals """
+        terms = sorted(self._gram.terminals)
+        codes = {t: i for i, t in enumerate(terms)}
+        matrix = array('b', [NO_PREC_REL_CODE]) * (len(terms) * len(terms))
+        for k1, subdict in self._pt.items():
+            row = codes[k1] * len(terms)
+            for k2, v in subdict.items():
+                matrix[row + codes[k2]] = PREC_REL_CODES[v]
+        return matrix
+    @classmethod
+    def from_matrix(cls, gram, matrix):
+        pt = cls(gram)
+        terms = sorted(gram.terminals)
+        relations = {code: rel for rel, code in PREC_REL_CODES.items()}
+        for i, k1 in enumerate(terms):
+            row = matrix[i * len(terms):(i + 1) * len(terms)].tolist()
+            subdict = {terms[j]: relations[v] for j, v in enumerate(row) if v != NO_PREC_REL_CODE}
+            if subdict:
+                pt._pt[k1] = subdict
+        return pt
+    @classmethod
+    def from_grammar_cached(cls, gram, cache_dir=None):
+        """ from_grammar through the on-disk cache of the tables """
+        from table_cache import cached_tables
+        tables = cached_tables(gram, ('matrix',), lambda: {'matrix': cls.from_grammar(gram).to_matrix()}, cache_dir)
+        return cls.from_matrix(gram, tables['matrix'])
+
 class PrecedenceParser(object):
-    def __init__(self, pt, core_gram):
+    """ The reduce rules are looked up by their rhs tuple, the stack positions
+    of the terminals are kept along with the stack for the pivot search.
+    """
+    def __init__(self, pt, core_gram, verbose=False, reduce_index=None):
+        """ reduce_index is {rhs tuple: rule indices} of the core grammar, make_reduce_index(core_gram) by default """
         self._pt = pt
         self._core_gram = core_gram
-    def _search_rule_pivot_to_reduce(self, stack):
-        stack_terminals = [(i, e) for i, e in enumerate(stack) if e != CORE_AXIOM]
-        for i in reversed(range(len(stack_terminals))):
-            if i == 0:
-                raise ValueError('cant find rule to reduce in the stack: {}'.format(stack))
-            (prev_i, prev), (_, cur) = stack_terminals[i-1:i+1]
-            prec_rel = self._pt[prev, cur]
+        self._verbose = verbose
+        rules = {rule.index: rule for rule in core_gram.rules}
+        if reduce_index is None:
+            reduce_index = make_reduce_index(core_gram)
+        self._reduce_rules = {rhs: [rules[i] for i in indices] for rhs, indices in reduce_index.items()}
+        self._rule_operators = {}
+        for rule in core_gram.rules:
+            self._rule_operators[rule.index] = [t for t in rule.rhs if core_gram.is_operator(t)]
+    def _search_rule_pivot_to_reduce(self, stack, terminal_positions):
+        for k in reversed(range(1, len(terminal_positions))):
+            prev_i, cur_i = terminal_positions[k - 1], terminal_positions[k]
+            prec_rel = self._pt[stack[prev_i], stack[cur_i]]
             assert prec_rel is not None
             if prec_rel == PREC_REL_EQ:
                 continue
             return prev_i + 1
+        raise ValueError('cant find rule to reduce in the stack: {}'.format(stack))
     def parse(self, tokens):
-        if not all(self._core_gram.is_term(t.kind) for t in tokens):
-            raise ValueError('unknown terminals in input: {}'.format([t for t in tokens if self._core_gram.is_nonterm(t)]))
+        if not all(self._core_gram.is_term(t.terminal) for t in tokens):
+            raise ValueError('unknown terminals in input: {}'.format([t.value for t in tokens if self._core_gram.is_nonterm(t.terminal)]))
+        pt, verbose = self._pt, self._verbose
         stack, res, rpns, cur_rpn = [EOF], [], [], []
-        while not (stack == [EOF, CORE_AXIOM] and tokens == [EOF_TOKEN]):
-            print('stack: {}'.format(stack))
-            stack_top, next_token = stack[-1], tokens[0]
-            assert stack_top == CORE_AXIOM or self._core_gram.is_term(stack_top), stack
-            if stack_top == CORE_AXIOM:
-                stack_top = stack[-2]
-            assert stack_top != CORE_AXIOM
-
-            precedence_relation = self._pt[stack_top, next_token.kind]
+        terminal_positions = [0] # stack indices of the terminals, the others are CORE_AXIOM
+        pos, last_pos = 0, len(tokens) - 1
+        while not (len(stack) == 2 and stack[1] == CORE_AXIOM and pos == last_pos and tokens[pos] is EOF_TOKEN):
+            if verbose:
+                print('stack: {}'.format(stack))
+            stack_top, next_token = stack[terminal_positions[-1]], tokens[pos]
+            next_terminal = next_token.terminal
+
+            precedence_relation = pt[stack_top, next_terminal]
             if precedence_relation is None:
-                raise ValueError('cant parse grammar: no precedence relation between "{}" and "{}"'.format(stack_top, next_token.kind))
+                raise ValueError('cant parse grammar: no precedence relation between "{}" and "{}"'.format(stack_top, next_terminal))
             if precedence_relation in (PREC_REL_LT, PREC_REL_EQ): # shift
                 if next_token.is_value:
                     cur_rpn.append(next_token.value)
-                stack.append(tokens.pop(0).kind)
+                terminal_positions.append(len(stack))
+                stack.append(next_terminal)
+                pos += 1
                 continue
 
             # reduce
-            pivot_i = self._search_rule_pivot_to_reduce(stack)
-            pivot = stack[pivot_i:]
+            pivot_i = self._search_rule_pivot_to_reduce(stack, terminal_positions)
+            pivot = tuple(stack[pivot_i:])
             del stack[pivot_i:]
-            reduce_rules = [r for r in self._core_gram.rules if r.rhs == pivot]
+            while terminal_positions[-1] >= pivot_i:
+                terminal_positions.pop()
+            reduce_rules = self._reduce_rules.get(pivot)
             if not reduce_rules:
                 raise ValueError('cant reduce')
             assert len(reduce_rules) == 1, reduce_rules
@@ -142,7 +216,7 @@ class PrecedenceParser(object):
             stack.append(CORE_AXIOM)
 
             # rpn actions
-            reduce_rule_operators = [t for t in reduce_rule.rhs if self._core_gram.is_operator(t)]
+            reduce_rule_operators = self._rule_operators[reduce_rule.index]
             if reduce_rule_operators:
                 assert len(reduce_rule_operators) == 1 # current limitation: can't be > 1
                 cur_rpn.append(reduce_rule_operators[0])
@@ -152,16 +226,25 @@ class PrecedenceParser(object):
         return res, rpns
 
 def tokenize(data):
-    tokens = data.split()
-    for token in tokens:
-        if token == 'id' or token.startswith('id_'):
-            yield Bunch(kind='id', value=token, is_value=True)
-        elif token == 'k' or token.isdigit():
-            yield Bunch(kind='k', value=token, is_value=True)
-        else:
-            yield Bunch(kind=token, value=token, is_value=False)
+    """ lexer tokens of the str or bytes-like data, the grammar terminal of a token is token.terminal """
+    yield from iter_tokens(data)
     yield EOF_TOKEN
 
+def make_reduce_index(core_gram):
+    reduce_index = {}
+    for rule in core_gram.rules:
+        reduce_index.setdefault(tuple(rule.rhs), []).append(rule.index)
+    return reduce_index
+
+def cached_reduce_index(gram, core_gram, cache_dir=None):
+    """ make_reduce_index(core_gram) through the on-disk cache of the tables of gram """
+    from table_cache import cached_tables, reduce_index_to_arrays, reduce_index_from_arrays
+    terms = sorted(gram.terminals)
+    codes = {t: i for i, t in enumerate(terms)}
+    tables = cached_tables(gram, ('reduce_rhs', 'reduce_offsets', 'reduce_rules'),
+                           lambda: reduce_index_to_arrays(make_reduce_index(core_gram), codes), cache_dir)
+    return reduce_index_from_arrays(tables, terms, CORE_AXIOM)
+
 def make_core_grammar(gram):
     def replace_by_start_symbol(rule):
         new_rhs = [e if gram.is_term(e) else CORE_AXIOM for e in rule.rhs]
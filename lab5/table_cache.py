@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+""" On-disk cache of the compiled precedence tables of the grammars.
+
+A grammar is keyed by the sha256 of its start symbol, terminals, operators and
+rules. The file of a key holds named flat arrays: a JSON header line with the
+key, the typecode, offset and length of every array and the sha256 of them along
+with the arrays data, then the raw arrays aligned to ALIGNMENT bytes.
+The file is memory-mapped on load and checked against the sha256,
+an array is a memoryview of the map cast to its typecode, so nothing is parsed
+or copied. A file that does not match is rebuilt.
+The terminal codes in the arrays are the indices of the sorted terminals.
+"""
+import hashlib
+import json
+import mmap
+import os
+from array import array
+
+CACHE_VERSION = 1 # a part of the key, bump it when a table construction changes
+CACHE_DIR = os.environ.get('PRECEDENCE_CACHE_DIR') or \
+    os.path.join(os.path.expanduser('~'), '.cache', 'precedence')
+ALIGNMENT = 8
+NONTERM_CODE = -1
+
+def _aligned(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+def _arrays_digest(arrays, data):
+    """ sha256 of the arrays layout of the header and of the data after it """
+    digest = hashlib.sha256(json.dumps(arrays, sort_keys=True).encode('utf-8'))
+    for chunk in data:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def grammar_key(gram):
+    rules = [(r.index, r.lhs, list(r.rhs)) for r in gram.rules]
+    data = [CACHE_VERSION, gram.start_symbol, sorted(gram.terminals), sorted(gram.operators), rules]
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def cache_path(gram, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, 'precedence-{}.tables'.format(grammar_key(gram)[:32]))
+
+def load_tables(gram, cache_dir=None):
+    """ {name: memoryview} of the cached arrays of the grammar, empty if there are none """
+    try:
+        with open(cache_path(gram, cache_dir), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError): # no file or an empty one
+        return {}
+    header_end = data.find(b'\n') + 1
+    view = memoryview(data)[_aligned(header_end):]
+    tables = {}
+    try:
+        header = json.loads(data[:header_end].decode('utf-8'))
+        if header['key'] != grammar_key(gram):
+            return {}
+        if _arrays_digest(header['arrays'], (view,)) != header['sha256']: # a truncated or corrupted file
+            return {}
+        for name, (typecode, offset, length) in header['arrays'].items():
+            end = offset + length * array(typecode).itemsize
+            if not 0 <= offset <= end <= len(view):
+                return {}
+            tables[name] = view[offset:end].cast(typecode)
+    except (ValueError, KeyError, TypeError, AttributeError): # a header that is not ours
+        return {}
+    return tables
+
+def save_tables(gram, tables, cache_dir=None):
+    """ Write the {name: array} tables of the grammar along with its cached ones.
+    The file is replaced at once, a cache that cannot be written is skipped.
+    """
+    tables = dict(load_tables(gram, cache_dir), **tables)
+    arrays, offset, data = {}, 0, []
+    for name, a in sorted(tables.items()):
+        a = memoryview(a)
+        arrays[name] = (a.format, offset, len(a))
+        offset += _aligned(a.nbytes)
+        data += (a.cast('B'), bytes(_aligned(a.nbytes) - a.nbytes))
+    header = json.dumps({'key': grammar_key(gram), 'sha256': _arrays_digest(arrays, data),
+                         'arrays': arrays}).encode('utf-8') + b'\n'
+    path = cache_path(gram, cache_dir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(bytes(_aligned(len(header)) - len(header)))
+            for chunk in data:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def cached_tables(gram, names, build, cache_dir=None):
+    """ The cached tables of the grammar if it has all the names, else the ones of build() saved to the cache """
+    tables = load_tables(gram, cache_dir)
+    if all(name in tables for name in names):
+        return tables
+    tables = build()
+    save_tables(gram, tables, cache_dir)
+    return tables
+
+def reduce_index_to_arrays(reduce_index, codes):
+    """ {rhs: rule indices} as the rhs codes of every rule, their offsets and the rule indices """
+    rhs_codes, offsets, rules = array('i'), array('i', [0]), array('i')
+    for rhs, indices in reduce_index.items():
+        for index in indices:
+            rhs_codes.extend(codes.get(s, NONTERM_CODE) for s in rhs)
+            offsets.append(len(rhs_codes))
+            rules.append(index)
+    return {'reduce_rhs': rhs_codes, 'reduce_offsets': offsets, 'reduce_rules': rules}
+
+def reduce_index_from_arrays(tables, terminals, nonterm):
+    symbols = list(terminals) + [nonterm] # NONTERM_CODE is the last one
+    rhs_codes, offsets = tables['reduce_rhs'].tolist(), tables['reduce_offsets'].tolist()
+    reduce_index = {}
+    for i, index in enumerate(tables['reduce_rules'].tolist()):
+        rhs = tuple(symbols[c] for c in rhs_codes[offsets[i]:offsets[i + 1]])
+        reduce_index.setdefault(rhs, []).append(index)
+    return reduce_index
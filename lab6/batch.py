@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+""" Data-parallel operator precedence parsing with the precedence functions.
+
+The tokens are encoded as an array of terminal codes, the relations of all the
+adjacent terminals are signs of f[left] - g[right]. The handles made of adjacent
+terminals, a < x1 = ... = xk > b, are found at once: the start of the handle
+ending at every '>' is the one after the last non-'=' relation, a running maximum.
+The other terminals are split into chunks reduced independently: a chunk starts
+with the terminal before it as the left context, the terminals whose left
+relation goes into the unknown context ('>', or '=' to such a terminal) are left
+unreduced along with the handles waiting for the right context. The residues of
+the chunks are reduced together at last.
+
+The terminals are numbered by their positions after the leading '$', the
+nonterminal between two terminals of a handle is there if their positions
+are not adjacent. A reduction is (left terminal, right terminal, rule index),
+the sequential parser does the reductions by the right terminal and then
+the inner ones first, so sorting them gives the same rules and RPNs.
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from main import CompactPrecedenceTable, PrecedenceParser, make_core_grammar, tokenize
+from parser import CORE_AXIOM
+from gram import EOF
+from lexer import TERMINALS, VALUE_KINDS
+
+CHUNK_TERMINALS = 1 << 15
+NONTERM_CODE = NO_CODE = -1
+NO_RULE = -1
+
+def _init_worker(tables):
+    """ The precedence functions and the reduce index are sent to every worker once, not per chunk """
+    global _tables
+    _tables = tables
+
+def _reduce_chunk(args):
+    """ Reductions of the terminals between the first one, the left context, and the last one, the lookahead.
+    Returns the flat (left, right, rule) triples and the positions and the codes of the unreduced terminals.
+    """
+    positions, codes = args
+    f, g, reduce_index = _tables
+    stack_positions, stack_codes, eq_links = [positions[0]], [codes[0]], [False]
+    frozen_n = 1 # the bottom of the stack is never reduced here
+    reductions = []
+    last = len(positions) - 1
+    for i in range(1, last + 1):
+        b_pos, b_code = positions[i], codes[i]
+        gb = g[b_code]
+        while len(stack_positions) > frozen_n and f[stack_codes[-1]] > gb:
+            k = len(stack_positions) - 1
+            while eq_links[k]:
+                k -= 1
+            key = []
+            prev = left = stack_positions[k - 1]
+            for j in range(k, len(stack_positions)):
+                if stack_positions[j] - prev > 1:
+                    key.append(NONTERM_CODE)
+                key.append(stack_codes[j])
+                prev = stack_positions[j]
+            if b_pos - prev > 1:
+                key.append(NONTERM_CODE)
+            rule = reduce_index.get(tuple(key), NO_RULE)
+            if rule == NO_RULE:
+                raise ValueError('cant reduce')
+            reductions += (left, b_pos, rule)
+            del stack_positions[k:], stack_codes[k:], eq_links[k:]
+        if i == last:
+            break
+        top_f = f[stack_codes[-1]]
+        if len(stack_positions) == frozen_n and top_f >= gb:
+            frozen_n += 1
+        stack_positions.append(b_pos)
+        stack_codes.append(b_code)
+        eq_links.append(top_f == gb)
+    return reductions, stack_positions[1:], stack_codes[1:]
+
+class BatchPrecedenceParser(PrecedenceParser):
+    """ Parser of the whole token list at once with the integer precedence functions.
+    The rules and the RPNs are the ones of PrecedenceParser.parse, an input the batch
+    reductions fail on is parsed again by it for its error.
+    The chunks are reduced in this process by default. jobs > 1 reduces them in a process
+    pool, but the chunk passes are only about a half of the parse time and their tokens are
+    pickled to the workers, so the pool pays off on many cores only, if at all.
+    """
+    def __init__(self, cpt, core_gram, jobs=1, chunk_terminals=CHUNK_TERMINALS):
+        super().__init__(cpt, core_gram)
+        self._jobs = jobs
+        self._chunk_terminals = chunk_terminals
+        self._terms = tuple(sorted(core_gram.terminals))
+        self._codes = {t: i for i, t in enumerate(self._terms)}
+        self._value_codes = [self._codes[TERMINALS[kind]] for kind in VALUE_KINDS if TERMINALS[kind] in self._codes]
+        self._f = np.array([cpt._f[t] for t in self._terms], dtype=np.intp)
+        self._g = np.array([cpt._g[t] for t in self._terms], dtype=np.intp)
+        reduce_index = {}
+        self._leaf_rules = np.full(len(self._terms), NO_RULE, dtype=np.intp)
+        for rhs, rules in self._reduce_rules.items():
+            if len(rules) != 1:
+                continue
+            key = tuple(NONTERM_CODE if t == CORE_AXIOM else self._codes[t] for t in rhs)
+            reduce_index[key] = rules[0].index
+            if len(key) == 1 and key[0] != NONTERM_CODE:
+                self._leaf_rules[key[0]] = rules[0].index
+        self._tables = (self._f.tolist(), self._g.tolist(), reduce_index)
+        self._rule_operators_array = [None] * (max(self._rule_operators, default=-1) + 1)
+        for index, operators in self._rule_operators.items():
+            if operators:
+                assert len(operators) == 1 # current limitation: can't be > 1
+                self._rule_operators_array[index] = operators[0]
+        self._has_operators = np.array([op is not None for op in self._rule_operators_array], dtype=bool)
+    def _leaf_handles(self, codes):
+        """ Reductions of the handles of adjacent terminals and the mask of their terminals """
+        rel = np.sign(self._f[codes[:-1]] - self._g[codes[1:]]) # rel[i] is the relation of terminals i and i + 1
+        indices = np.arange(len(rel))
+        last_not_eq = np.maximum.accumulate(np.where(rel != 0, indices, -1))
+        ends = np.flatnonzero(rel[1:] > 0) + 1 # handles end before the lookahead, after the leading '$'
+        starts = last_not_eq[ends - 1] + 1
+        handles = (starts >= 1) & (rel[np.maximum(starts - 1, 0)] < 0)
+        starts, ends = starts[handles], ends[handles]
+        rules = np.full(len(starts), NO_RULE, dtype=np.intp)
+        single = starts == ends
+        rules[single] = self._leaf_rules[codes[starts[single]]]
+        reduce_index = self._tables[2]
+        for i in np.flatnonzero(~single).tolist():
+            rules[i] = reduce_index.get(tuple(codes[starts[i]:ends[i] + 1].tolist()), NO_RULE)
+        if (rules == NO_RULE).any():
+            raise ValueError('cant reduce')
+        covered = np.zeros(len(codes) + 1, dtype=np.intp)
+        np.add.at(covered, starts, 1)
+        np.add.at(covered, ends + 1, -1)
+        return (starts - 1, ends + 1, rules), np.cumsum(covered[:-1]) > 0
+    def _reduce(self, codes):
+        """ Arrays of the lefts, the rights and the rules of all the reductions """
+        (lefts, rights, rules), covered = self._leaf_handles(codes)
+        positions = np.flatnonzero(~covered)
+        rest_codes = codes[positions]
+        chunks = [(positions[lo - 1:lo + self._chunk_terminals + 1].tolist(),
+                   rest_codes[lo - 1:lo + self._chunk_terminals + 1].tolist())
+                  for lo in range(1, max(len(positions) - 1, 1), self._chunk_terminals)]
+        if self._jobs == 1 or len(chunks) <= 1:
+            _init_worker(self._tables)
+            results = list(map(_reduce_chunk, chunks))
+        else:
+            with ProcessPoolExecutor(max_workers=self._jobs, initializer=_init_worker,
+                                     initargs=(self._tables,)) as executor:
+                results = list(executor.map(_reduce_chunk, chunks))
+            _init_worker(self._tables)
+        residue_positions, residue_codes = [int(positions[0])], [int(rest_codes[0])]
+        chunk_reductions = []
+        for reductions, chunk_positions, chunk_codes in results:
+            chunk_reductions += reductions
+            residue_positions += chunk_positions
+            residue_codes += chunk_codes
+        residue_positions.append(int(positions[-1]))
+        residue_codes.append(int(rest_codes[-1]))
+        reductions, residue, _ = _reduce_chunk((residue_positions, residue_codes))
+        if residue or positions[-1] - positions[0] < 2: # not accepted as '$ S $'
+            raise ValueError('cant parse')
+        chunk_reductions = np.array(chunk_reductions + reductions, dtype=np.intp).reshape(-1, 3).T
+        return (np.concatenate((lefts, chunk_reductions[0])), np.concatenate((rights, chunk_reductions[1])),
+                np.concatenate((rules, chunk_reductions[2])))
+    def parse(self, tokens):
+        get_code = self._codes.get
+        codes = np.array([self._codes[EOF]] + [get_code(t.terminal, NO_CODE) for t in tokens], dtype=np.intp)
+        if len(codes) < 2 or codes[-1] != self._codes[EOF] or (codes == NO_CODE).any():
+            return super().parse(tokens)
+        try:
+            lefts, rights, rules = self._reduce(codes)
+        except ValueError:
+            return super().parse(tokens)
+        order = np.lexsort((-lefts, rights))
+        rights, rules = rights[order], rules[order]
+
+        # rpn actions: the values are shifted after the reductions by them
+        operators = self._rule_operators_array
+        with_operators = self._has_operators[rules]
+        value_positions = np.flatnonzero(np.isin(codes, self._value_codes))
+        events = np.concatenate((rules[with_operators], -1 - value_positions)) # the values are negative
+        events = events[np.lexsort((events < 0, np.concatenate((rights[with_operators], value_positions))))]
+        rpns, cur_rpn = [], []
+        for event in events.tolist():
+            if event < 0:
+                cur_rpn.append(tokens[-2 - event].value)
+                continue
+            cur_rpn.append(operators[event])
+            if operators[event] == '=':
+                rpns.append(cur_rpn)
+                cur_rpn = []
+        return rules.tolist(), rpns
+
+if __name__ == '__main__':
+    from gram import test_grammar
+    with open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin as f:
+        tokens = list(tokenize(f.read()))
+    parser = BatchPrecedenceParser(CompactPrecedenceTable.from_grammar(test_grammar), make_core_grammar(test_grammar))
+    parse_rules, rpns = parser.parse(tokens)
+    print('parse rules: {}'.format(parse_rules))
+    print('RPNs: \n{}'.format('\n'.join(' '.join(rpn) for rpn in rpns)))
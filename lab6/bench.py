@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" Benchmarks for the construction of the precedence functions on generated grammars """
+import copy
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+import numpy as np
+
+from main import CompactPrecedenceTable, PrecedenceTable, PrecedenceParser, make_core_grammar, tokenize
+from main import PREC_REL_LT, PREC_REL_GT, PREC_REL_EQ
+from gram import test_grammar
+from batch import BatchPrecedenceParser
+
+LAB6_DIR = os.path.dirname(os.path.abspath(__file__))
+LAB5_DIR = os.path.join(LAB6_DIR, os.pardir, 'lab5')
+INPUT_PATH = os.path.join(LAB6_DIR, 'input.txt')
+
+def _load_lab5_bench():
+    """ lab5/bench.py is loaded by its path, this module is bench too """
+    spec = importlib.util.spec_from_file_location('lab5_bench', os.path.join(LAB5_DIR, 'bench.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+make_grammar = _load_lab5_bench().make_grammar
+
+class GraphNode(object):
+    def __init__(self, data, successors=None):
+        self.successors = successors or []
+        self.data = data
+
+def legacy_precedence_functions(row_terminals, col_terminals, squashed_matr):
+    """ The original graph stage: node objects, a loop check on a deep copy and relaxations until no changes """
+    f_nodes = [GraphNode(data={'f_terms': rt, 'kind': 'f'}) for rt in row_terminals]
+    g_nodes = [GraphNode(data={'g_terms': ct, 'kind': 'g'}) for ct in col_terminals]
+    for i, j in zip(*(squashed_matr == 0).nonzero()):
+        f_nodes[i] = g_nodes[j] = GraphNode(
+            data={'f_terms': f_nodes[i].data['f_terms'], 'g_terms': g_nodes[j].data['g_terms'], 'kind': 'fg'})
+    for i in range(len(f_nodes)):
+        for j in range(len(g_nodes)):
+            v = squashed_matr[i, j]
+            if v == CompactPrecedenceTable.VAL_GT:
+                f_nodes[i].successors.append(g_nodes[j])
+            elif v == CompactPrecedenceTable.VAL_LT:
+                g_nodes[j].successors.append(f_nodes[i])
+    nodes = set(f_nodes + g_nodes)
+
+    loop_nodes = copy.deepcopy(nodes)
+    while loop_nodes:
+        final_node = next((n for n in loop_nodes if not n.successors), None)
+        if final_node is None:
+            raise ValueError('precedence graph contains loops, cant buld compact precedence grammar')
+        loop_nodes.remove(final_node)
+        for node in loop_nodes:
+            if final_node in node.successors:
+                node.successors.remove(final_node)
+
+    for node in nodes:
+        node.data['max_path'] = 0
+    have_changes = True
+    while have_changes:
+        have_changes = False
+        for node in nodes:
+            old_val = node.data['max_path']
+            if not node.successors:
+                continue
+            node.data['max_path'] = max(s.data['max_path'] for s in node.successors) + 1
+            have_changes = have_changes or (node.data['max_path'] != old_val)
+
+    f_nodes = [n for n in nodes if 'f' in n.data['kind']]
+    g_nodes = [n for n in nodes if 'g' in n.data['kind']]
+    f, g = {}, {}
+    for terms in row_terminals:
+        for term in terms:
+            f[term] = next(n for n in f_nodes if term in n.data['f_terms']).data['max_path']
+    for terms in col_terminals:
+        for term in terms:
+            g[term] = next(n for n in g_nodes if term in n.data['g_terms']).data['max_path']
+    return f, g
+
+class LoopCompactPrecedenceTable(CompactPrecedenceTable):
+    """ The matrix, squashing and graph stages cell by cell in Python loops """
+    @staticmethod
+    def _precedence_table_to_matrix(pt, gram_terminals, verbose=False):
+        matr = np.empty(shape=(len(gram_terminals), len(gram_terminals)), dtype=np.int8)
+        matr.fill(CompactPrecedenceTable.VAL_EMPTY)
+        terminals = {t: i for i, t in enumerate(sorted(gram_terminals))}
+        for k1, subdict in pt._pt.items():
+            for k2, v in subdict.items():
+                i, j = terminals[k1], terminals[k2]
+                if v == PREC_REL_EQ:
+                    matr[i, j] = CompactPrecedenceTable.VAL_EQ
+                elif v == PREC_REL_LT:
+                    matr[i, j] = CompactPrecedenceTable.VAL_LT
+                elif v == PREC_REL_GT:
+                    matr[i, j] = CompactPrecedenceTable.VAL_GT
+        return matr
+    @staticmethod
+    def _squash_precedence_matrix(terminals, matr, verbose=False):
+        def squash_rows(m):
+            row2term = {}
+            for i, t in terminals:
+                row = tuple(m[i])
+                if row2term.get(row) is None:
+                    row2term[row] = {'index': i, 'terms': []}
+                row2term[row]['terms'].append(t)
+            squashed_rows = []
+            row_terminals = []
+            for row, row_info in sorted(row2term.items(), key=lambda v: v[1]['index']):
+                row_terminals.append(row_info['terms'])
+                squashed_rows.append(row)
+            return row_terminals, np.array(squashed_rows)
+        row_terminals, squashed_rows_matrix = squash_rows(matr)
+        col_terminals, squashed_cols_matrix = squash_rows(squashed_rows_matrix.T)
+        return row_terminals, col_terminals, squashed_cols_matrix.T
+    @staticmethod
+    def _build_precedence_graph(row_terminals, col_terminals, squashed_matr, verbose=False):
+        rows_n, cols_n = len(row_terminals), len(col_terminals)
+        parents = list(range(rows_n + cols_n))
+        def find(node):
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+        for i, j in zip(*np.where(squashed_matr == 0)):
+            parents[find(rows_n + j)] = find(i)
+        row_nodes = [find(i) for i in range(rows_n)]
+        col_nodes = [find(rows_n + j) for j in range(cols_n)]
+        sources, targets = array('i'), array('i')
+        for i in range(rows_n):
+            for j in range(cols_n):
+                v = squashed_matr[i, j]
+                if v == CompactPrecedenceTable.VAL_GT:
+                    sources.append(row_nodes[i])
+                    targets.append(col_nodes[j])
+                elif v == CompactPrecedenceTable.VAL_LT:
+                    sources.append(col_nodes[j])
+                    targets.append(row_nodes[i])
+        return row_nodes, col_nodes, rows_n + cols_n, sources, targets
+
+def build_seconds(cls, pt, gram):
+    start = time.perf_counter()
+    matrix = cls._precedence_table_to_matrix(pt, gram.terminals)
+    row_terminals, col_terminals, squashed_matr = cls._squash_precedence_matrix(
+        tuple(enumerate(sorted(gram.terminals))), matrix)
+    f, g = cls._precedence_functions(row_terminals, col_terminals, squashed_matr)
+    return time.perf_counter() - start, (f, g)
+
+def bench_build(levels=(10, 50, 100, 200, 400, 800), atoms_n=10):
+    print('%8s %10s %12s %12s' % ('levels', 'terminals', 'loops s', 's'))
+    for levels_n in levels:
+        gram = make_grammar(levels_n, atoms_n)
+        pt = PrecedenceTable.from_grammar(gram)
+        loop_seconds, loop_fg = build_seconds(LoopCompactPrecedenceTable, pt, gram)
+        seconds, fg = build_seconds(CompactPrecedenceTable, pt, gram)
+        assert fg == loop_fg
+        print('%8d %10d %12.3f %12.3f' % (levels_n, len(gram.terminals), loop_seconds, seconds))
+
+def squashed_matrix(gram):
+    pt = PrecedenceTable.from_grammar(gram)
+    matrix = CompactPrecedenceTable._precedence_table_to_matrix(pt, gram.terminals)
+    terminals = tuple(enumerate(sorted(gram.terminals)))
+    return CompactPrecedenceTable._squash_precedence_matrix(terminals, matrix)
+
+def bench_precedence_functions(levels=(10, 50, 100, 200, 400), atoms_n=10, legacy_max=200):
+    print('%8s %10s %8s %12s %12s' % ('levels', 'terminals', 'nodes', 'legacy s', 's'))
+    for levels_n in levels:
+        gram = make_grammar(levels_n, atoms_n)
+        row_terminals, col_terminals, squashed_matr = squashed_matrix(gram)
+        start = time.perf_counter()
+        f, g = CompactPrecedenceTable._precedence_functions(row_terminals, col_terminals, squashed_matr)
+        seconds = time.perf_counter() - start
+        legacy = '-'
+        if levels_n <= legacy_max:
+            start = time.perf_counter()
+            assert legacy_precedence_functions(row_terminals, col_terminals, squashed_matr) == (f, g)
+            legacy = '%.3f' % (time.perf_counter() - start)
+        print('%8d %10d %8d %12s %12.3f' % (levels_n, len(gram.terminals), len(row_terminals) + len(col_terminals),
+                                            legacy, seconds))
+
+def bench_batch_parser(blocks=(10 ** 2, 10 ** 3, 10 ** 4), jobs=(1, os.cpu_count())):
+    """ The sequential parser against the batch one on the input.txt block repeated in one block.
+    The speedup is the one of the vectorized passes in one process, jobs=1, the pool reduces
+    only the chunks and gives no more on the cores measured so far.
+    """
+    cpt = CompactPrecedenceTable.from_grammar(test_grammar)
+    core_gram = make_core_grammar(test_grammar)
+    with open(INPUT_PATH) as f:
+        block = f.read().strip()
+    print('%8s %10s %16s' % ('blocks', 'tokens', 'sequential tok/s') +
+          ''.join('%18s' % 'jobs={} tok/s'.format(j) for j in jobs))
+    for blocks_n in blocks:
+        tokens = list(tokenize('{ ' + ' ; '.join([block] * blocks_n) + ' }'))
+        start = time.perf_counter()
+        result = PrecedenceParser(cpt, core_gram).parse(tokens)
+        row = '%8d %10d %16.0f' % (blocks_n, len(tokens), len(tokens) / (time.perf_counter() - start))
+        for jobs_n in jobs:
+            parser = BatchPrecedenceParser(cpt, core_gram, jobs=jobs_n)
+            start = time.perf_counter()
+            assert parser.parse(tokens) == result
+            row += '%18.0f' % (len(tokens) / (time.perf_counter() - start))
+        print(row)
+
+def startup_seconds(main_path, cache_dir, runs=5):
+    """ Best wall time of main.py on input.txt with the cache directory, all the runs but the first are warm """
+    env = dict(os.environ, PRECEDENCE_CACHE_DIR=cache_dir)
+    seconds = []
+    with open(INPUT_PATH) as f:
+        for _ in range(runs):
+            f.seek(0)
+            start = time.perf_counter()
+            subprocess.run([sys.executable, main_path], stdin=f, stdout=subprocess.DEVNULL, env=env, check=True)
+            seconds.append(time.perf_counter() - start)
+    return seconds[0], min(seconds[1:])
+
+def bench_table_cache(levels=(50, 200, 400), atoms_n=10):
+    print('%30s %10s %10s' % ('startup', 'cold s', 'warm s'))
+    for name, lab_dir in (('lab5/main.py', LAB5_DIR), ('lab6/main.py', LAB6_DIR)):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold, warm = startup_seconds(os.path.join(lab_dir, 'main.py'), cache_dir)
+        print('%30s %10.3f %10.3f' % (name, cold, warm))
+    for levels_n in levels:
+        gram = make_grammar(levels_n, atoms_n)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            start = time.perf_counter()
+            cold = CompactPrecedenceTable.from_grammar_cached(gram, cache_dir)
+            cold_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            warm = CompactPrecedenceTable.from_grammar_cached(gram, cache_dir)
+            warm_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            PrecedenceTable.from_grammar_cached(gram, cache_dir)
+            pt_seconds = time.perf_counter() - start
+        assert (warm._f, warm._g) == (cold._f, cold._g)
+        print('%30s %10.3f %10.3f' % ('f, g of %d terminals' % len(gram.terminals), cold_seconds, warm_seconds))
+        print('%30s %10s %10.3f' % ('table of %d terminals' % len(gram.terminals), '', pt_seconds))
+
+if __name__ == '__main__':
+    bench_precedence_functions()
+    bench_build()
+    bench_batch_parser()
+    bench_table_cache()
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 import sys
 import os
-sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from array import array
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir, 'lab5')))
 import numpy as np
 
-from lab5.parser import PrecedenceParser, PrecedenceTable
-from lab5.parser import PREC_REL_LT, PREC_REL_GT, PREC_REL_EQ
-from lab5.parser import make_core_grammar, tokenize
+from parser import PrecedenceParser, PrecedenceTable
+from parser import PREC_REL_LT, PREC_REL_GT, PREC_REL_EQ
+from parser import make_core_grammar, cached_reduce_index, tokenize
+from table_cache import cached_tables
 
 class CompactPrecedenceTable(object):
     VAL_EMPTY = -2
@@ -36,7 +38,7 @@ class CompactPrecedenceTable(object):
         def print_table(self):
             from sys import stdout
             stdout.write(' ' * 5)
-            terms = tuple(sorted(k for k, _ in self._f.iteritems()))
+            terms = tuple(sorted(k for k, _ in self._f.items()))
             for term in terms:
                 stdout.write('%5s' % term)
             print('\n' + '-' * 5 * (len(terms) + 1))
@@ -49,24 +51,20 @@ class CompactPrecedenceTable(object):
         print_table(self)
 
     @staticmethod
-    def _precedence_table_to_matrix(pt, gram_terminals):
-        matr = np.empty(shape=(len(gram_terminals), len(gram_terminals)), dtype=np.int8)
-        matr.fill(CompactPrecedenceTable.VAL_EMPTY)
-        terminals = {t: i for i, t in enumerate(sorted(gram_terminals))}
-        for k1, subdict in pt._pt.iteritems():
-            for k2, v in subdict.iteritems():
-                i, j = terminals[k1], terminals[k2]
-                if v == PREC_REL_EQ:
-                    matr[i, j] = CompactPrecedenceTable.VAL_EQ
-                elif v == PREC_REL_LT:
-                    matr[i, j] = CompactPrecedenceTable.VAL_LT
-                elif v == PREC_REL_GT:
-                    matr[i, j] = CompactPrecedenceTable.VAL_GT
+    def _precedence_table_to_matrix(pt, gram_terminals, verbose=False):
+        terms = tuple(sorted(gram_terminals))
+        terminals = {t: i for i, t in enumerate(terms)}
+        values = {PREC_REL_EQ: CompactPrecedenceTable.VAL_EQ, PREC_REL_LT: CompactPrecedenceTable.VAL_LT,
+                  PREC_REL_GT: CompactPrecedenceTable.VAL_GT}
+        matr = np.full((len(terms), len(terms)), CompactPrecedenceTable.VAL_EMPTY, dtype=np.int8)
+        for k1, subdict in pt._pt.items():
+            js = np.fromiter(map(terminals.__getitem__, subdict.keys()), dtype=np.intp, count=len(subdict))
+            matr[terminals[k1], js] = np.fromiter(map(values.__getitem__, subdict.values()), dtype=np.int8,
+                                                  count=len(subdict))
 
         def print_matrix():
             print('Precedence matrix:')
             sys.stdout.write(' ' * 5)
-            terms = tuple(sorted(gram_terminals))
             for term in terms:
                 sys.stdout.write('%5s' % term)
             print('\n' + '-' * 5 * (len(terms) + 1))
@@ -77,26 +75,29 @@ class CompactPrecedenceTable(object):
                 print('')
             print('\n' + '-' * 5 * (len(terms) + 1))
 
-        print_matrix()
+        if verbose:
+            print_matrix()
         return matr
 
     @staticmethod
-    def _squash_precedence_matrix(terminals, matr):
+    def _squash_precedence_matrix(terminals, matr, verbose=False):
         def squash_rows(m):
-            row2term = {}
-            for i, t in terminals:
-                row = tuple(m[i])
-                if row2term.get(row) is None:
-                    row2term[row] = {'index': i, 'terms': []}
-                row2term[row]['terms'].append(t)
-
-            squashed_rows = []
-            row_terminals = []
-            for row, row_info in sorted(row2term.iteritems(), key=lambda v: v[1]['index']):
-                row_terminals.append(row_info['terms'])
-                squashed_rows.append(row)
-            print(squashed_rows)
-            return row_terminals, np.array(squashed_rows)
+            """ Unique rows in the order of their first occurrences and the terminals of every row.
+            The rows are compared as opaque byte strings, np.unique(axis=0) compares them by elements.
+            """
+            m = np.ascontiguousarray(m)
+            rows = m.view(np.dtype((np.void, m.dtype.itemsize * m.shape[1]))).ravel()
+            _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+            order = np.argsort(first)
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            row_terminals = [[] for _ in order]
+            for (_, t), row in zip(terminals, rank[inverse.ravel()].tolist()):
+                row_terminals[row].append(t)
+            squashed_rows = m[first[order]]
+            if verbose:
+                print(squashed_rows)
+            return row_terminals, squashed_rows
 
         row_terminals, squashed_rows_matrix = squash_rows(matr)
         col_terminals, squashed_cols_matrix = squash_rows(squashed_rows_matrix.T)
@@ -116,106 +117,123 @@ class CompactPrecedenceTable(object):
                 print('')
             print('\n' + '-' * w * (len(row_terminals) + 1))
 
-        print_squashed_matrix(squashed_matr)
+        if verbose:
+            print_squashed_matrix(squashed_matr)
         return row_terminals, col_terminals, squashed_matr
 
-    class GraphNode(object):
-        def __init__(self, data, successors=None):
-            self.successors = successors or []
-            self.data = data
-        def __repr__(self):
-            return 'GraphNode(data={}, successors_n={})'.format(self.data, len(self.successors))
-
     @staticmethod
-    def _build_precedence_graph(row_terminals, col_terminals, squashed_matr):
-        f_nodes = [CompactPrecedenceTable.GraphNode(data={'f_terms': rt, 'kind':'f'}) for rt in row_terminals]
-        g_nodes = [CompactPrecedenceTable.GraphNode(data={'g_terms': ct, 'kind':'g'}) for ct in col_terminals]
-        zero_elems = zip(*np.where(squashed_matr == 0))
-        print(squashed_matr)
-        print(zero_elems)
-        for index_pair in zero_elems:
-            i, j = index_pair
-            print(i)
-            f_nodes[i] = g_nodes[j] = CompactPrecedenceTable.GraphNode(data=
-                {'f_terms': f_nodes[i].data['f_terms'], 'g_terms': g_nodes[j].data['g_terms'], 'kind': 'fg'})
-        for i in range(len(f_nodes)):
-            for j in range(len(g_nodes)):
-                v = squashed_matr[i, j]
-                if v in (CompactPrecedenceTable.VAL_EMPTY, CompactPrecedenceTable.VAL_EQ):
-                    continue
-                assert v in (CompactPrecedenceTable.VAL_LT, CompactPrecedenceTable.VAL_GT), v
-                if v == CompactPrecedenceTable.VAL_GT:
-                    f_nodes[i].successors.append(g_nodes[j])
-                else:
-                    g_nodes[j].successors.append(f_nodes[i])
-        return set(f_nodes + g_nodes)
+    def _build_precedence_graph(row_terminals, col_terminals, squashed_matr, verbose=False):
+        """ Nodes of the f rows and the g columns and the edges between them as parallel arrays.
+        Node i is row i, node len(rows) + j is column j, the columns equal to rows are the row nodes.
+        """
+        rows_n, cols_n = len(row_terminals), len(col_terminals)
+        parents = list(range(rows_n + cols_n))
+        def find(node):
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+        zero_i, zero_j = np.nonzero(squashed_matr == CompactPrecedenceTable.VAL_EQ)
+        zero_elems = list(zip(zero_i.tolist(), zero_j.tolist()))
+        if verbose:
+            print(squashed_matr)
+            print(zero_elems)
+        for i, j in zero_elems:
+            parents[find(rows_n + j)] = find(i)
+        row_nodes = np.array([find(i) for i in range(rows_n)], dtype=np.intp)
+        col_nodes = np.array([find(rows_n + j) for j in range(cols_n)], dtype=np.intp)
+        assert np.isin(squashed_matr, (CompactPrecedenceTable.VAL_EMPTY, CompactPrecedenceTable.VAL_EQ,
+                                       CompactPrecedenceTable.VAL_LT, CompactPrecedenceTable.VAL_GT)).all()
+        gt_i, gt_j = np.nonzero(squashed_matr == CompactPrecedenceTable.VAL_GT)
+        lt_i, lt_j = np.nonzero(squashed_matr == CompactPrecedenceTable.VAL_LT)
+        sources = np.concatenate((row_nodes[gt_i], col_nodes[lt_j]))
+        targets = np.concatenate((col_nodes[gt_j], row_nodes[lt_i]))
+        return row_nodes.tolist(), col_nodes.tolist(), rows_n + cols_n, sources, targets
 
     @staticmethod
-    def _does_graph_contain_loops(nodes):
-        import copy
-        nodes = copy.deepcopy(nodes)
-        while nodes:
-            final_node = next((n for n in nodes if not n.successors), None)
-            if final_node is None: # loop found
-                return True
-            nodes.remove(final_node)
-            for node in nodes:
-                if final_node in node.successors:
-                    node.successors.remove(final_node)
-        return False
+    def _longest_paths(nodes_n, sources, targets):
+        """ Lengths of the longest paths from the nodes to the sinks or None if the graph has loops.
+        Kahn's algorithm from the sinks over the predecessors in the arrays of offsets and nodes.
+        """
+        sources, targets = np.asarray(sources, dtype=np.intp), np.asarray(targets, dtype=np.intp)
+        out_degrees = np.bincount(sources, minlength=nodes_n).tolist()
+        pred_offsets = np.concatenate(([0], np.cumsum(np.bincount(targets, minlength=nodes_n)))).tolist()
+        preds = sources[np.argsort(targets, kind='stable')].tolist()
+
+        paths = [0] * nodes_n
+        q = [v for v in range(nodes_n) if not out_degrees[v]]
+        for v in q:
+            path = paths[v] + 1
+            for u in preds[pred_offsets[v]:pred_offsets[v + 1]]:
+                if paths[u] < path:
+                    paths[u] = path
+                out_degrees[u] -= 1
+                if not out_degrees[u]:
+                    q.append(u)
+        return paths if len(q) == nodes_n else None
 
-    @staticmethod
-    def _mark_longest_paths_in_precedence_graph(nodes):
-        for node in nodes:
-            node.data['max_path'] = 0
-        have_changes = True
-        while have_changes:
-            have_changes = False
-            for node in nodes:
-                old_val = node.data['max_path']
-                if not node.successors:
-                    continue
-                node.data['max_path'] = max(s.data['max_path'] for s in node.successors) + 1
-                have_changes = have_changes or (node.data['max_path'] != old_val)
+    @classmethod
+    def from_grammar(cls, gram, verbose=False):
+        return cls.from_precedence_table(PrecedenceTable.from_grammar(gram), gram, verbose)
+
+    @classmethod
+    def from_grammar_cached(cls, gram, cache_dir=None, verbose=False):
+        """ from_grammar through the on-disk cache of the tables, the precedence table is cached too """
+        terms = sorted(gram.terminals)
+        def build():
+            cpt = cls.from_precedence_table(PrecedenceTable.from_grammar_cached(gram, cache_dir), gram, verbose)
+            return {'f': array('q', [cpt._f[t] for t in terms]), 'g': array('q', [cpt._g[t] for t in terms])}
+        tables = cached_tables(gram, ('f', 'g'), build, cache_dir)
+        return cls(f=dict(zip(terms, tables['f'].tolist())), g=dict(zip(terms, tables['g'].tolist())))
 
     @classmethod
-    def from_grammar(cls, gram):
-        pt = PrecedenceTable.from_grammar(gram)
-        matrix = cls._precedence_table_to_matrix(pt, gram.terminals)
+    def from_precedence_table(cls, pt, gram, verbose=False):
+        matrix = cls._precedence_table_to_matrix(pt, gram.terminals, verbose)
         terminals = tuple(enumerate(sorted(gram.terminals)))
-        row_terminals, col_terminals, squashed_matr = cls._squash_precedence_matrix(terminals, matrix)
+        row_terminals, col_terminals, squashed_matr = cls._squash_precedence_matrix(terminals, matrix, verbose)
         assert row_terminals and col_terminals
 
-        nodes = cls._build_precedence_graph(row_terminals, col_terminals, squashed_matr)
-        assert nodes
-        if cls._does_graph_contain_loops(nodes):
-            raise ValueError('precedence graph contains loops, cant buld compact precedence grammar')
-        cls._mark_longest_paths_in_precedence_graph(nodes)
+        f, g = cls._precedence_functions(row_terminals, col_terminals, squashed_matr, verbose)
+        return cls(f=f, g=g)
 
-        f_nodes = [n for n in nodes if 'f' in n.data['kind']]
-        g_nodes = [n for n in nodes if 'g' in n.data['kind']]
+    @classmethod
+    def _precedence_functions(cls, row_terminals, col_terminals, squashed_matr, verbose=False):
+        row_nodes, col_nodes, nodes_n, sources, targets = cls._build_precedence_graph(
+            row_terminals, col_terminals, squashed_matr, verbose)
+        paths = cls._longest_paths(nodes_n, sources, targets)
+        if paths is None:
+            raise ValueError('precedence graph contains loops, cant buld compact precedence grammar')
 
         f, g = {}, {}
-        for _, term in terminals:
-            term_f_nodes = [n for n in f_nodes if term in n.data['f_terms']]
-            assert len(term_f_nodes) == 1, (term, term_f_nodes)
-            f[term] = term_f_nodes[0].data['max_path']
-
-            term_g_nodes = [n for n in g_nodes if term in n.data['g_terms']]
-            assert len(term_g_nodes) == 1, (term, term_g_nodes)
-            g[term] = term_g_nodes[0].data['max_path']
-
-        return cls(f=f, g=g)
+        for terms, node in zip(row_terminals, row_nodes):
+            for term in terms:
+                f[term] = paths[node]
+        for terms, node in zip(col_terminals, col_nodes):
+            for term in terms:
+                g[term] = paths[node]
+        return f, g
 
 if __name__ == '__main__':
-    from lab5.gram import test_grammar
+    from gram import test_grammar
+    import argparse
+    argparser = argparse.ArgumentParser(description='Operator precedence parser of the test grammar, the program is stdin')
+    argparser.add_argument('--no-cache', action='store_true', help='build the tables without reading or writing the cache')
+    argparser.add_argument('--cache-dir', help='directory of the cached tables, ~/.cache/precedence by default')
+    args = argparser.parse_args()
+
     for i, rule in enumerate(test_grammar.rules):
         print('rule #{}: {} -> {}'.format(i, rule.lhs, ' '.join(rule.rhs)))
     print('')
 
-    cpt = CompactPrecedenceTable.from_grammar(test_grammar)
+    debug = os.environ.get('DEBUG') == '1' # the construction dumps, they are not cached
+    if debug or args.no_cache:
+        cpt = CompactPrecedenceTable.from_grammar(test_grammar, verbose=debug)
+    else:
+        cpt = CompactPrecedenceTable.from_grammar_cached(test_grammar, args.cache_dir)
     cpt.dump()
-    parser = PrecedenceParser(cpt, make_core_grammar(test_grammar))
+    core_gram = make_core_grammar(test_grammar)
+    reduce_index = None if args.no_cache else cached_reduce_index(test_grammar, core_gram, args.cache_dir)
+    parser = PrecedenceParser(cpt, core_gram, reduce_index=reduce_index)
     parse_rules, rpns = parser.parse(list(tokenize(sys.stdin.read())))
     print('parse rules: {}'.format(parse_rules))
     print('RPNs: \n{}'.format('\n'.join(' '.join(rpn) for rpn in rpns)))
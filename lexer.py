@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" Lexer of the labs programs, one master regex for all the token kinds.
+
+The tokens need no spaces between them: "id_0=1+5" is id_0 = 1 + 5.
+A token is its kind and a slice of the source, the value is cut out on access.
+The source is a str or a bytes-like object, e.g. a memory-mapped file.
+"""
+import mmap
+import re
+from array import array
+
+KIND_EOF, KIND_ID, KIND_CONST, KIND_OP, KIND_NAME, KIND_OTHER = range(6)
+KIND_NAMES = ('eof', 'id', 'const', 'op', 'name', 'other')
+# grammar terminals of the kinds, the other tokens are terminals by their values
+TERMINALS = {KIND_EOF: '$', KIND_ID: 'id', KIND_CONST: 'k'}
+VALUE_KINDS = frozenset((KIND_ID, KIND_CONST))
+
+# the group numbers are the kinds, the longer operators go first
+TOKEN_PATTERN_TEMPLATE = r'''\s*(?:
+    (id_%(w)s*|id(?!%(w)s))
+    |([0-9]+|k(?!%(w)s))
+    |(<=|>=|<>|==|[-+*/=<>(){};])
+    |([A-Za-z_]%(w)s*)
+    |(%(other)s)
+)'''
+TOKEN_PATTERN = TOKEN_PATTERN_TEMPLATE % {'w': r'\w', 'other': r'\S'}
+# a non-ASCII character of a bytes source is one whole UTF-8 sequence and a word character
+UTF8_SEQUENCE = r'[\xc0-\xff][\x80-\xbf]*'
+TOKEN_BYTES_PATTERN = TOKEN_PATTERN_TEMPLATE % {'w': r'(?:\w|%s)' % UTF8_SEQUENCE, 'other': r'%s|\S' % UTF8_SEQUENCE}
+TOKEN_RE = re.compile(TOKEN_PATTERN, re.VERBOSE)
+TOKEN_BYTES_RE = re.compile(TOKEN_BYTES_PATTERN.encode('ascii'), re.VERBOSE)
+
+class Token(object):
+    __slots__ = ('kind', 'source', 'start', 'end')
+    def __init__(self, kind, source, start, end):
+        self.kind = kind
+        self.source = source
+        self.start = start
+        self.end = end
+    @property
+    def value(self):
+        value = self.source[self.start:self.end]
+        return value if isinstance(value, str) else value.decode('utf-8')
+    @property
+    def terminal(self):
+        return TERMINALS.get(self.kind) or self.value
+    @property
+    def is_value(self):
+        return self.kind in VALUE_KINDS
+    def __repr__(self):
+        return 'Token({}, {!r})'.format(KIND_NAMES[self.kind], self.value)
+
+EOF_TOKEN = Token(KIND_EOF, '', 0, 0)
+
+def _token_re(source):
+    return TOKEN_RE if isinstance(source, str) else TOKEN_BYTES_RE
+
+def iter_tokens(source, pos=0, endpos=None):
+    """ Tokens of source[pos:endpos]. A bytes source is UTF-8, its non-ASCII characters
+    are word characters and its spaces are ASCII, otherwise the tokens are the ones of the str.
+    >>> [t.value for t in iter_tokens('id_длина=1+ё')]
+    ['id_длина', '=', '1', '+', 'ё']
+    >>> [t.value for t in iter_tokens('id_длина=1+ё'.encode('utf-8'))]
+    ['id_длина', '=', '1', '+', 'ё']
+    """
+    token_re = _token_re(source)
+    for m in token_re.finditer(source, pos, len(source) if endpos is None else endpos):
+        kind = m.lastindex
+        yield Token(kind, source, m.start(kind), m.end(kind))
+
+class TokenArrays(object):
+    """ Tokens as parallel arrays of kinds and value slices """
+    __slots__ = ('source', 'kinds', 'starts', 'ends')
+    def __init__(self, source):
+        self.source = source
+        self.kinds, self.starts, self.ends = array('B'), array('q'), array('q')
+        kinds_append, starts_append, ends_append = self.kinds.append, self.starts.append, self.ends.append
+        for m in _token_re(source).finditer(source):
+            kind = m.lastindex
+            kinds_append(kind)
+            starts_append(m.start(kind))
+            ends_append(m.end(kind))
+    def __len__(self):
+        return len(self.kinds)
+    def value(self, i):
+        value = self.source[self.starts[i]:self.ends[i]]
+        return value if isinstance(value, str) else value.decode('utf-8')
+    def __getitem__(self, i):
+        return Token(self.kinds[i], self.source, self.starts[i], self.ends[i])
+
+def iter_stream_tokens(f, chunk_size=1 << 16):
+    """ Tokens of a text file object read by chunks, their sources are the chunks.
+    The last token of a chunk may continue in the next one, it is lexed again with it.
+    """
+    tail = ''
+    while True:
+        chunk = f.read(chunk_size)
+        source = tail + chunk
+        if not chunk:
+            yield from iter_tokens(source)
+            return
+        last = None
+        for m in TOKEN_RE.finditer(source):
+            if last is not None:
+                kind = last.lastindex
+                yield Token(kind, source, last.start(kind), last.end(kind))
+            last = m
+        if last is None:
+            tail = ''
+        elif last.end() == len(source):
+            tail = source[last.start():]
+        else:
+            kind = last.lastindex
+            yield Token(kind, source, last.start(kind), last.end(kind))
+            tail = ''
+
+def map_file(path):
+    """ Read-only memory map of the file, an empty bytes object for an empty file """
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # cannot mmap an empty file
+            return b''
+
+def tokenize_file(path):
+    """ Tokens of the memory-mapped file """
+    return iter_tokens(map_file(path))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    import sys
+    source = map_file(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin.read()
+    for token in iter_tokens(source):
+        print('{:6} {}'.format(KIND_NAMES[token.kind], token.value))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+""" Benchmarks for the Thue interpreter on the scaled up inc_bin_numbers sample """
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from thue import parse_program, execute_program, INPUT_GETTER_OPERATOR, MEMORY_BACKENDS, STRATEGIES
+from thue import split_program, load_compiled_program, execute_compiled_program, LeftmostStrategy, RandomStrategy
+
+THUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thue.py')
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples', 'inc_bin_numbers.txt')
+
+def make_inc_bin_numbers_program(numbers_n, width, seed=0, dead_rules_n=0):
+    """ The sample with random input numbers and rules that never match """
+    with open(SAMPLE) as f:
+        lines = f.read().splitlines()
+    rng = random.Random(seed)
+    rules_end = lines.index('::=')
+    numbers = [''.join(rng.choice('01') for _ in range(width)) for _ in range(numbers_n)]
+    dead_rules = ['#{}# ::= x'.format(i) for i in range(dead_rules_n)]
+    return lines[:rules_end] + dead_rules + lines[rules_end:rules_end + 2] + numbers + ['!!!']
+
+def execute_program_naive(rules, memory, input_lines, **kwargs):
+    """ The original interpreter: shuffle all rules and scan the memory on every step """
+    steps = 0
+    match_found = True
+    while match_found:
+        match_found = False
+        random.shuffle(rules)
+        for rule in rules:
+            if rule.lhs in memory:
+                if rule.rhs == INPUT_GETTER_OPERATOR:
+                    replacement = input_lines.pop(0) if input_lines else ''
+                elif rule.rhs.startswith('~'):
+                    sys.stdout.write(rule.rhs[1:] or '\n')
+                    replacement = ''
+                else:
+                    replacement = rule.rhs
+                match_found = True
+                memory = memory.replace(rule.lhs, replacement, 1)
+                steps += 1
+                break
+    return steps
+
+def run(execute, lines, **kwargs):
+    program = parse_program(lines)
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        start = time.perf_counter()
+        steps = execute(**dict(program, **kwargs))
+        elapsed = time.perf_counter() - start
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return steps, elapsed, output
+
+def bench_matching():
+    print('steps/sec, inc_bin_numbers')
+    print('%8s %8s %12s %12s' % ('numbers', 'width', 'naive', 'indexed'))
+    for numbers_n, width in ((10, 16), (10, 256), (10, 1024), (100, 1024), (10, 4096)):
+        lines = make_inc_bin_numbers_program(numbers_n, width)
+        naive_steps, naive_time, naive_output = run(execute_program_naive, lines)
+        steps, elapsed, output = run(execute_program, lines)
+        assert output == naive_output
+        print('%8d %8d %12.0f %12.0f' % (numbers_n, width, naive_steps / naive_time, steps / elapsed))
+
+class SteadyStateTimer(object):
+    """ Strategy wrapper that times the steps after the input is inserted into the memory """
+    def __init__(self, strategy, rules):
+        self._strategy = strategy
+        self._rules = rules
+        self._input_step = None
+        self.steps = 0
+        self.times = []
+    def choose(self, index):
+        # called before the step self.steps, after the previous one is replaced and reindexed
+        now = time.perf_counter()
+        if self._input_step is not None:
+            self.times.append(now)
+        choice = self._strategy.choose(index)
+        if choice is not None and self._input_step is None and self._rules[choice[0]].rhs == INPUT_GETTER_OPERATOR:
+            self._input_step = self.steps
+        self.steps += 1
+        return choice
+
+def run_memory_backend(memory_backend, width, max_steps):
+    """ Seconds until the input is inserted and indexed, seconds per step afterwards and peak RSS """
+    program = parse_program(make_inc_bin_numbers_program(1, width))
+    timer = SteadyStateTimer(RandomStrategy(0), program['rules'])
+    start = time.perf_counter()
+    execute_program(memory_backend=memory_backend, max_steps=max_steps, strategy=timer, output=io.StringIO(), **program)
+    insert_seconds = timer.times[0] - start
+    step_seconds = (timer.times[-1] - timer.times[0]) / (len(timer.times) - 1)
+    return insert_seconds, step_seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_memory_backends(max_steps=20000):
+    """ The input insertion scans the whole new memory once, it is reported apart from the steps after it """
+    print('input insertion time, steady time per step and peak RSS, inc_bin_numbers, first {} steps'.format(max_steps))
+    print('%8s %8s %12s %12s %12s' % ('memory', 'MB', 'insert, s', 'us/step', 'RSS, MB'))
+    for width in (2 ** 20, 4 * 2 ** 20):
+        for memory_backend in sorted(MEMORY_BACKENDS):
+            with ProcessPoolExecutor(max_workers=1) as executor: # fresh process for a clean peak RSS
+                insert_seconds, step_seconds, rss = executor.submit(run_memory_backend, memory_backend, width, max_steps).result()
+            print('%8s %8d %12.2f %12.2f %12.1f' % (memory_backend, width // 2 ** 20, insert_seconds,
+                                                    step_seconds * 1e6, rss / 1024.0))
+
+def bench_strategies():
+    print('steps/sec, inc_bin_numbers with never matching rules')
+    print('%8s %12s' % ('rules', 'naive') + ''.join('%12s' % name for name in sorted(STRATEGIES)))
+    for dead_rules_n in (0, 100, 1000, 10000):
+        lines = make_inc_bin_numbers_program(10, 64, dead_rules_n=dead_rules_n)
+        naive_steps, naive_time, _ = run(execute_program_naive, lines)
+        row = '%8d %12.0f' % (dead_rules_n, naive_steps / naive_time)
+        for name in sorted(STRATEGIES):
+            steps, elapsed, _ = run(execute_program, lines, strategy=STRATEGIES[name]())
+            row += '%12.0f' % (steps / elapsed)
+        print(row)
+
+def bench_streaming():
+    print('input lines/sec, inc_bin_numbers run as a process with stdin from a file')
+    print('%10s %12s %12s' % ('lines', 'read all', 'stream'))
+    for numbers_n in (10 ** 4, 10 ** 5):
+        with tempfile.TemporaryFile('w+') as f:
+            f.write('\n'.join(make_inc_bin_numbers_program(numbers_n, 4)) + '\n')
+            row = '%10d' % numbers_n
+            for args in ([], ['--stream']):
+                f.seek(0)
+                start = time.perf_counter()
+                subprocess.check_call([sys.executable, THUE, '--strategy', 'leftmost'] + args, stdin=f, stdout=subprocess.DEVNULL)
+                row += ' %12.0f' % (numbers_n / (time.perf_counter() - start))
+            print(row)
+
+def bench_compiler():
+    """ Warm runs load the module cached by the cold one, the seed changes the input only """
+    print('seconds to load and run inc_bin_numbers, leftmost strategy')
+    print('%8s %12s %12s %12s' % ('numbers', 'interpreted', 'cold', 'warm'))
+    for numbers_n in (100, 1000):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            def interpreted(lines):
+                return execute_program(strategy=LeftmostStrategy(), output=io.StringIO(), **parse_program(lines))
+            def compiled(lines):
+                rule_lines, memory, input_lines = split_program(lines)
+                module = load_compiled_program(rule_lines, cache_dir)
+                return execute_compiled_program(module, memory, input_lines, strategy=LeftmostStrategy(), output=io.StringIO())
+            row = '%8d' % numbers_n
+            for seed, execute in enumerate((interpreted, compiled, compiled)):
+                text = '\n'.join(make_inc_bin_numbers_program(numbers_n, 32, seed))
+                start = time.perf_counter()
+                execute(text.splitlines())
+                row += ' %12.3f' % (time.perf_counter() - start)
+            print(row)
+
+if __name__ == '__main__':
+    bench_matching()
+    bench_memory_backends()
+    bench_strategies()
+    bench_streaming()
+    bench_compiler()
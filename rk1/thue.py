@@ -1,6 +1,18 @@
+import bisect
+import hashlib
+import heapq
+import importlib.util
+import os
+import random
+import re
+import struct
+import sys
+
 REPLACE_OPERATOR = '::='
 END_OPERATOR = '!!!'
 INPUT_GETTER_OPERATOR = ':::'
+TRACE_RECORD = struct.Struct('<QIQ') # step, rule index, position
+COMPILER_VERSION = 2
 
 class Rule(object):
     def __init__(self, lhs, rhs):
@@ -9,56 +21,490 @@ class Rule(object):
     def __repr__(self):
         return '{} ::= {}'.format(self.lhs, self.rhs)
 
-def parse_program(program_lines):
-    memory = None
-    rules = []
-    input_lines = []
-    end_of_rules_found = False
-    end_found = False
-
-    for line in program_lines:
-        if not end_of_rules_found:
-            if line == REPLACE_OPERATOR:
-                end_of_rules_found = True
-                continue
-            rules.append(Rule(*line.split(' ::= ')))
-        elif memory is None:
-            memory = line
-        elif not end_found:
-            if line == END_OPERATOR:
-                end_found = True
-                continue
-            input_lines.append(line)
+class Automaton(object):
+    """ Aho-Corasick automaton over the rules left hand sides.
+    Pattern indices are the rule indices.
+    """
+    def __init__(self, patterns):
+        assert all(patterns), 'empty left hand side'
+        self.lengths = tuple(len(p) for p in patterns)
+        self.max_length = max(self.lengths) if patterns else 0
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (i,)
+        q = list(self._goto[0].values())
+        for state in q:
+            for ch, next_state in self._goto[state].items():
+                q.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = fail
+                self._out[next_state] += self._out[self._fail[next_state]]
+    def tables(self):
+        return self.lengths, self._goto, self._fail, self._out
+    @classmethod
+    def from_tables(cls, lengths, goto, fail, out):
+        automaton = cls.__new__(cls)
+        automaton.lengths = lengths
+        automaton.max_length = max(lengths) if lengths else 0
+        automaton._goto, automaton._fail, automaton._out = goto, fail, out
+        return automaton
+    def iter_matches(self, text, begin=0, end=None):
+        """ Yield (start position, pattern index) for all matches inside text[begin:end] """
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self.lengths
+        state = 0
+        for i, ch in enumerate(text[begin:end], begin):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for k in out[state]:
+                yield i - lengths[k] + 1, k
+
+class MatchIndex(object):
+    """ Live matches of the rules in the memory.
+    Matches are kept on two stacks around a gap, the same way a gap buffer keeps
+    characters: matches left of the gap by start position, matches right of it by
+    distance from the memory end. A rewrite at the gap shifts nothing, only the
+    window around the rewritten span is rescanned.
+    """
+    def __init__(self, automaton):
+        self._automaton = automaton
+        self._size = 0
+        self._gap = 0
+        self._left = [] # (start, rule index), ascending start
+        self._right = [] # (distance from the end, rule index), ascending distance
+        self._left_by_rule = [[] for _ in automaton.lengths]
+        self._right_by_rule = [[] for _ in automaton.lengths]
+        self._applicable = []
+        self._applicable_pos = {}
+        self._applicable_heap = [] # may contain rules that are not applicable anymore
+        self._in_heap = set()
+    def _match_added(self, k):
+        if len(self._left_by_rule[k]) + len(self._right_by_rule[k]) == 1:
+            self._applicable_pos[k] = len(self._applicable)
+            self._applicable.append(k)
+            if k not in self._in_heap:
+                self._in_heap.add(k)
+                heapq.heappush(self._applicable_heap, k)
+    def _match_removed(self, k):
+        if not self._left_by_rule[k] and not self._right_by_rule[k]:
+            i = self._applicable_pos.pop(k)
+            last = self._applicable.pop()
+            if last != k:
+                self._applicable[i] = last
+                self._applicable_pos[last] = i
+    def _move_gap(self, gap):
+        left, right, size = self._left, self._right, self._size
+        while right and size - right[-1][0] < gap:
+            d, k = right.pop()
+            self._right_by_rule[k].pop()
+            left.append((size - d, k))
+            self._left_by_rule[k].append(size - d)
+        while left and left[-1][0] >= gap:
+            s, k = left.pop()
+            self._left_by_rule[k].pop()
+            right.append((size - s, k))
+            self._right_by_rule[k].append(size - s)
+        self._gap = gap
+    def _scan(self, memory, begin, end):
+        # add the matches starting inside [begin, end), there are none of them yet
+        window_end = min(len(memory), end + self._automaton.max_length - 1)
+        matches = sorted((begin + s, k) for s, k in self._automaton.iter_matches(memory.slice(begin, window_end))
+                         if begin + s < end)
+        i = 0
+        while i < len(matches) and matches[i][0] < self._gap:
+            s, k = matches[i]
+            self._left.append((s, k))
+            self._left_by_rule[k].append(s)
+            self._match_added(k)
+            i += 1
+        for s, k in reversed(matches[i:]):
+            self._right.append((self._size - s, k))
+            self._right_by_rule[k].append(self._size - s)
+            self._match_added(k)
+    def add_all(self, memory):
+        assert not self._left and not self._right
+        self._size = len(memory)
+        self._gap = 0
+        self._scan(memory, 0, len(memory))
+    def update(self, memory, begin, end, new_end):
+        """ Reindex after memory[begin:end] was replaced by memory[begin:new_end] """
+        self._move_gap(begin)
+        window_begin = max(0, begin - self._automaton.max_length + 1)
+        left, right = self._left, self._right
+        while left and left[-1][0] >= window_begin:
+            _, k = left.pop()
+            self._left_by_rule[k].pop()
+            self._match_removed(k)
+        while right and self._size - right[-1][0] < end:
+            _, k = right.pop()
+            self._right_by_rule[k].pop()
+            self._match_removed(k)
+        self._size = len(memory)
+        self._scan(memory, window_begin, new_end)
+    def leftmost(self, k):
+        """ Start of the leftmost match of the rule k """
+        if self._left_by_rule[k]:
+            return self._left_by_rule[k][0]
+        return self._size - self._right_by_rule[k][-1]
+    def leftmost_match(self):
+        """ (start, rule index) of the leftmost match or None """
+        if self._left:
+            return self._left[0]
+        if self._right:
+            d, k = self._right[-1]
+            return self._size - d, k
+        return None
+    def has_match(self, k, pos):
+        left_k, right_k = self._left_by_rule[k], self._right_by_rule[k]
+        i = bisect.bisect_left(left_k, pos)
+        if i < len(left_k) and left_k[i] == pos:
+            return True
+        i = bisect.bisect_left(right_k, self._size - pos)
+        return i < len(right_k) and right_k[i] == self._size - pos
+    def choice(self, rng=random):
+        """ Random applicable rule index or None """
+        return rng.choice(self._applicable) if self._applicable else None
+    def first_applicable(self):
+        """ Lowest applicable rule index or None """
+        heap = self._applicable_heap
+        while heap and heap[0] not in self._applicable_pos:
+            self._in_heap.remove(heapq.heappop(heap))
+        return heap[0] if heap else None
+
+class RandomStrategy(object):
+    """ Random applicable rule at its leftmost match, seeded for reproducible runs """
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+    def choose(self, index):
+        k = index.choice(self._rng)
+        return None if k is None else (k, index.leftmost(k))
+
+class LeftmostStrategy(object):
+    """ The leftmost match in the memory """
+    def choose(self, index):
+        match = index.leftmost_match()
+        return None if match is None else (match[1], match[0])
+
+class RuleOrderStrategy(object):
+    """ The first applicable rule in the program order at its leftmost match """
+    def choose(self, index):
+        k = index.first_applicable()
+        return None if k is None else (k, index.leftmost(k))
+
+class ReplayStrategy(object):
+    """ Choices read back from a trace written by execute_program """
+    def __init__(self, trace):
+        self._trace = trace
+        self._step = 0
+    def choose(self, index):
+        record = self._trace.read(TRACE_RECORD.size)
+        if not record:
+            return None
+        step, k, pos = TRACE_RECORD.unpack(record)
+        if step != self._step or not index.has_match(k, pos):
+            raise ValueError('trace does not match the program at step {}'.format(self._step))
+        self._step += 1
+        return k, pos
+
+STRATEGIES = {'random': RandomStrategy, 'leftmost': LeftmostStrategy, 'rule-order': RuleOrderStrategy}
+
+class StrMemory(object):
+    """ Plain immutable string, every replace copies the whole memory """
+    def __init__(self, s):
+        self._s = s
+    def __len__(self):
+        return len(self._s)
+    def __str__(self):
+        return self._s
+    def slice(self, begin, end):
+        return self._s[begin:end]
+    def replace(self, begin, end, s):
+        self._s = self._s[:begin] + s + self._s[end:]
+
+class GapBufferMemory(object):
+    """ Characters before the gap and reversed characters after it.
+    A replace costs the replacement length plus the gap movement.
+    """
+    def __init__(self, s):
+        self._left = []
+        self._right = list(reversed(s))
+    def __len__(self):
+        return len(self._left) + len(self._right)
+    def __str__(self):
+        return ''.join(self._left) + ''.join(reversed(self._right))
+    def _move_gap(self, pos):
+        left, right = self._left, self._right
+        if pos < len(left):
+            right.extend(reversed(left[pos:]))
+            del left[pos:]
+        elif pos > len(left):
+            n = pos - len(left)
+            left.extend(reversed(right[-n:]))
+            del right[-n:]
+    def slice(self, begin, end):
+        left, right = self._left, self._right
+        size = len(left) + len(right)
+        end = min(end, size)
+        if end <= len(left):
+            return ''.join(left[begin:end])
+        right_begin = max(begin, len(left))
+        return ''.join(left[begin:right_begin]) + ''.join(reversed(right[size - end:size - right_begin]))
+    def replace(self, begin, end, s):
+        self._move_gap(begin)
+        if end > begin:
+            del self._right[begin - end:]
+        self._left.extend(s)
+
+MEMORY_BACKENDS = {'str': StrMemory, 'gap': GapBufferMemory}
+
+class BlockWriter(object):
+    """ Collects the output and writes it to the stream in blocks """
+    def __init__(self, stream, block_size=1 << 16):
+        self._stream = stream
+        self._block_size = block_size
+        self._chunks = []
+        self._size = 0
+    def write(self, s):
+        self._chunks.append(s)
+        self._size += len(s)
+        if self._size >= self._block_size:
+            self.flush()
+    def flush(self):
+        self._stream.write(''.join(self._chunks))
+        self._stream.flush()
+        self._chunks = []
+        self._size = 0
+
+def iter_input_lines(lines):
+    for line in lines:
+        if line == END_OPERATOR:
+            return
+        yield line
+    assert False, 'no end of input'
+
+def split_program(program_lines, streaming=False):
+    """ (rule lines, memory, input lines) of the program, the rules are not parsed.
+    With streaming=True the input lines are pulled from program_lines lazily by the program.
+    """
+    rule_lines = []
+    lines = iter(program_lines)
+    for line in lines:
+        if line == REPLACE_OPERATOR:
+            break
+        rule_lines.append(line)
+    else:
+        assert False, 'no end of rules'
+    memory = next(lines, None)
+    assert memory is not None
+    input_lines = iter_input_lines(lines)
+    if not streaming:
+        input_lines = list(input_lines)
+        assert next(lines, None) is None
+    return rule_lines, memory, input_lines
+
+def parse_rules(rule_lines):
+    return [Rule(*line.split(' ::= ')) for line in rule_lines]
+
+def parse_program(program_lines, streaming=False):
+    """ With streaming=True only the rules and the memory are read, the input lines
+    are pulled from program_lines lazily by the program.
+    """
+    rule_lines, memory, input_lines = split_program(program_lines, streaming)
+    rules = parse_rules(rule_lines)
+    automaton = Automaton([rule.lhs for rule in rules])
+    return {'rules': rules, 'memory': memory, 'input_lines': input_lines, 'automaton': automaton}
+
+def _prepare_execution(automaton, memory, input_lines, memory_backend, strategy, output):
+    memory = MEMORY_BACKENDS[memory_backend](memory)
+    index = MatchIndex(automaton)
+    index.add_all(memory)
+    return memory, index, iter(input_lines), strategy or RandomStrategy(), output or sys.stdout
+
+def execute_program(rules, memory, input_lines, automaton=None, memory_backend='str', max_steps=None,
+                    strategy=None, trace=None, output=None):
+    """ Run the program until no rule is applicable or max_steps is reached, return the number of steps.
+    The strategy chooses the rule and the match to rewrite, the choices are written to
+    the binary trace file if it is given. input_lines may be any iterable, it is consumed lazily.
+    """
+    if automaton is None:
+        automaton = Automaton([rule.lhs for rule in rules])
+    memory, index, input_lines, strategy, output = _prepare_execution(
+        automaton, memory, input_lines, memory_backend, strategy, output)
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        choice = strategy.choose(index)
+        if choice is None:
+            break
+        k, pos = choice
+        if trace is not None:
+            trace.write(TRACE_RECORD.pack(steps, k, pos))
+        rule = rules[k]
+        if rule.rhs == INPUT_GETTER_OPERATOR:
+            replacement = next(input_lines, '')
+        elif rule.rhs.startswith('~'):
+            output.write(rule.rhs[1:] or '\n')
+            replacement = ''
         else:
-            assert(False)
-
-    assert(end_of_rules_found and memory is not None and end_found)
-    return {'rules': rules, 'memory': memory, 'input_lines': input_lines}
-
-def execute_program(rules, memory, input_lines):
-    import random
-    match_found = True
-    while match_found:
-        match_found = False
-        random.shuffle(rules) # The searches are non-deterministic (search order does not matter)
-        for rule in rules:
-            if rule.lhs in memory:
-                if rule.rhs == INPUT_GETTER_OPERATOR:
-                    replacement = input_lines.pop(0) if input_lines else ''
-                elif rule.rhs.startswith('~'):
-                    output = rule.rhs[1:]
-                    if output:
-                        sys.stdout.write(output)
-                    else:
-                        print('')
-                    replacement = ''
-                else:
-                    replacement = rule.rhs
-                match_found = True
-                memory = memory.replace(rule.lhs, replacement, 1)
+            replacement = rule.rhs
+        end = pos + len(rule.lhs)
+        memory.replace(pos, end, replacement)
+        index.update(memory, pos, end, pos + len(replacement))
+        steps += 1
+    return steps
+
+COMPILED_PROGRAM_TEMPLATE = '''# Generated by thue.py, do not edit
+import re
+
+AUTOMATON_TABLES = {automaton_tables!r}
+LEFTMOST_PATTERN = re.compile({pattern!r})
+
+def run(memory, index, input_lines, output, choose, trace, pack, max_steps):
+    replace, update, write = memory.replace, index.update, output.write
+    steps = 0
+    while steps != max_steps:
+        choice = choose(index)
+        if choice is None:
+            break
+        k, pos = choice
+        if trace is not None:
+            trace.write(pack(steps, k, pos))
+        end = pos + {lengths!r}[k]
+        replacement = {replacements!r}[k]
+{actions}        replace(pos, end, replacement)
+        update(memory, pos, end, pos + len(replacement))
+        steps += 1
+    return steps
+
+def run_leftmost(memory, input_lines, output, trace, pack, max_steps):
+    search, write = LEFTMOST_PATTERN.search, output.write
+    steps = start = 0
+    while steps != max_steps:
+        match = search(memory, start)
+        if match is None:
+            break
+        k, pos, end = match.lastindex - 1, match.start(), match.end()
+        if trace is not None:
+            trace.write(pack(steps, k, pos))
+        replacement = {replacements!r}[k]
+{actions}        memory = memory[:pos] + replacement + memory[end:]
+        start = max(0, pos - {rescan})
+        steps += 1
+    return steps
+'''
+
+def generate_program_source(rules, automaton):
+    """ Python module specialized to the rules: the rule tables are constants of the
+    step loops and the input and output handling is emitted only if some rule needs it.
+    Input rules have None as the replacement.
+    run_leftmost is the leftmost strategy on a str memory without the match index:
+    the lhs are the groups of one regex in the rule order, so a search finds the
+    leftmost match and the lowest rule at it, as LeftmostStrategy does. A rewrite
+    at pos leaves no match ending before it, the next search starts max_length - 1
+    characters before pos.
+    """
+    replacements = tuple(None if r.rhs == INPUT_GETTER_OPERATOR else '' if r.rhs.startswith('~') else r.rhs for r in rules)
+    outputs = tuple((r.rhs[1:] or '\n') if r.rhs.startswith('~') else None for r in rules)
+    actions = ''
+    if None in replacements:
+        actions += "        if replacement is None:\n            replacement = next(input_lines, '')\n"
+    if any(o is not None for o in outputs):
+        actions += "        text = {!r}[k]\n        if text is not None:\n            write(text)\n".format(outputs)
+    pattern = '|'.join('({})'.format(re.escape(r.lhs)) for r in rules) or '(?!)'
+    return COMPILED_PROGRAM_TEMPLATE.format(
+        automaton_tables=automaton.tables(), pattern=pattern, lengths=automaton.lengths,
+        replacements=replacements, actions=actions, rescan=max(automaton.max_length - 1, 0))
+
+def load_compiled_program(rule_lines, cache_dir):
+    """ Module generated from the rule lines of split_program, cached in cache_dir by
+    their hash. A cached module is imported without parsing the rules, the memory and
+    the input are not a part of it.
+    """
+    rules_text = '\n'.join(rule_lines)
+    key = hashlib.sha256('{}\n{}'.format(COMPILER_VERSION, rules_text).encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, 'thue_{}.py'.format(key))
+    if not os.path.exists(path):
+        rules = parse_rules(rule_lines)
+        source = generate_program_source(rules, Automaton([rule.lhs for rule in rules]))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        os.replace(tmp_path, path)
+    spec = importlib.util.spec_from_file_location('thue_{}'.format(key), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def execute_compiled_program(module, memory, input_lines, memory_backend='str', max_steps=None, strategy=None,
+                             trace=None, output=None):
+    """ Same as execute_program for a module returned by load_compiled_program.
+    The leftmost strategy on the str memory runs the loop specialized to it.
+    """
+    max_steps = -1 if max_steps is None else max_steps
+    if type(strategy) is LeftmostStrategy and memory_backend == 'str':
+        return module.run_leftmost(memory, iter(input_lines), output or sys.stdout, trace, TRACE_RECORD.pack, max_steps)
+    automaton = Automaton.from_tables(*module.AUTOMATON_TABLES)
+    memory, index, input_lines, strategy, output = _prepare_execution(
+        automaton, memory, input_lines, memory_backend, strategy, output)
+    return module.run(memory, index, input_lines, output, strategy.choose, trace, TRACE_RECORD.pack, max_steps)
 
 if __name__ == '__main__':
-    import sys
-    lines = sys.stdin.read().splitlines()
-    program = parse_program(lines)
-    execute_program(**program)
+    import argparse
+    argparser = argparse.ArgumentParser(description='Thue interpreter, reads the program from stdin')
+    argparser.add_argument('--memory', choices=sorted(MEMORY_BACKENDS), default='str', help='memory representation')
+    argparser.add_argument('--strategy', choices=sorted(STRATEGIES), default='random', help='rule choice strategy')
+    argparser.add_argument('--seed', type=int, help='seed of the random strategy')
+    argparser.add_argument('--trace', help='write the binary trace of the run to the file')
+    argparser.add_argument('--replay', help='replay the run from the binary trace file')
+    argparser.add_argument('--stream', action='store_true', help='read the input lines lazily and buffer the output')
+    argparser.add_argument('--compile', action='store_true', help='run the program compiled to a cached python module')
+    argparser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.cache', 'thue'),
+                           help='directory of the compiled programs')
+    args = argparser.parse_args()
+    if args.compile and args.stream:
+        argparser.error('--compile reads the whole input, it cannot be combined with --stream')
+    if args.compile:
+        rule_lines, memory, input_lines = split_program(sys.stdin.read().splitlines())
+        program = load_compiled_program(rule_lines, args.cache_dir)
+        output = sys.stdout
+    elif args.stream:
+        program = parse_program((line.rstrip('\n') for line in sys.stdin), streaming=True)
+        output = BlockWriter(sys.stdout)
+    else:
+        program = parse_program(sys.stdin.read().splitlines())
+        output = sys.stdout
+    if args.replay:
+        trace_input = open(args.replay, 'rb')
+        strategy = ReplayStrategy(trace_input)
+    elif args.strategy == 'random':
+        strategy = RandomStrategy(args.seed)
+    else:
+        strategy = STRATEGIES[args.strategy]()
+    trace = open(args.trace, 'wb') if args.trace else None
+    try:
+        if args.compile:
+            execute_compiled_program(program, memory, input_lines, memory_backend=args.memory, strategy=strategy,
+                                     trace=trace, output=output)
+        else:
+            execute_program(memory_backend=args.memory, strategy=strategy, trace=trace, output=output, **program)
+    finally:
+        output.flush()
+        if trace is not None:
+            trace.close()
+        if args.replay:
+            trace_input.close()